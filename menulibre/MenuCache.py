@@ -0,0 +1,189 @@
+#!/usr/bin/python3
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+#   MenuLibre - Advanced fd.o Compliant Menu Editor
+#   Copyright (C) 2012-2024 Sean Davis <sean@bluesabre.org>
+#
+#   This program is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License version 3, as published
+#   by the Free Software Foundation.
+#
+#   This program is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranties of
+#   MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+#   PURPOSE.  See the GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import logging
+import os
+
+from gi.repository import Gio, GLib  # type: ignore
+
+from . import util
+from .util import MenuItemTypes
+
+from menulibre_lib import get_version
+
+logger = logging.getLogger('menulibre')
+
+# Increment when the layout of the cached menu structure changes.
+CACHE_VERSION = 3
+
+# Environment variables that influence how GMenu builds the tree.
+CACHE_ENVIRONMENT = [
+    "XDG_MENU_PREFIX",
+    "XDG_CURRENT_DESKTOP",
+    "DESKTOP_SESSION",
+    "XDG_DATA_DIRS",
+    "XDG_CONFIG_DIRS",
+    "LANGUAGE",
+    "LC_ALL",
+    "LC_MESSAGES",
+    "LANG",
+]
+
+
+def get_cache_filename(basename):
+    """Return the cache filename for the specified menu basename."""
+    return os.path.join(util.getUserCacheDirectory(),
+                        "menu-%s.json" % basename)
+
+
+def get_source_directories():
+    """Return the directories GMenu reads while loading the menu tree."""
+    menu = util.getDefaultMenuName()
+    paths = []
+    for path in [GLib.get_user_data_dir()] + GLib.get_system_data_dirs():
+        paths.append(os.path.join(path, 'applications'))
+        paths.append(os.path.join(path, 'desktop-directories'))
+        if len(menu) > 0:
+            paths.append(os.path.join(path, menu, 'desktop-directories'))
+    for path in [GLib.get_user_config_dir()] + GLib.get_system_config_dirs():
+        paths.append(os.path.join(path, 'menus'))
+    return paths
+
+
+def get_cache_key(basename):
+    """Return a digest of everything the parsed menu tree depends on: the
+    environment and the mtime of every file and directory in the
+    applications, desktop-directories and menus directories."""
+    digest = hashlib.sha256()
+    parts = [str(CACHE_VERSION), get_version(), basename,
+             util.getDefaultMenuPrefix()]
+    for key in CACHE_ENVIRONMENT:
+        parts.append("%s=%s" % (key, os.environ.get(key, "")))
+    digest.update("\n".join(parts).encode('utf-8', 'surrogateescape'))
+
+    for path in get_source_directories():
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            filenames.sort()
+            for filename in [''] + filenames:
+                filename = os.path.join(dirpath, filename)
+                try:
+                    stamp = os.stat(filename).st_mtime_ns
+                except OSError:
+                    continue
+                line = "\n%s:%i" % (filename, stamp)
+                digest.update(line.encode('utf-8', 'surrogateescape'))
+
+    return digest.hexdigest()
+
+
+def serialize_items(items):
+    """Convert the get_submenus() structure to JSON-compatible lists."""
+    results = []
+    for item_type, entry_id, details, submenus in items:
+        if item_type == MenuItemTypes.SEPARATOR:  # type: ignore
+            results.append([item_type, None, None, None])
+            continue
+
+        details = dict(details)
+        icon = details['icon']
+        if icon is not None:
+            details['icon'] = icon.to_string()
+        if submenus is not None:
+            submenus = serialize_items(submenus)
+        results.append([item_type, entry_id, details, submenus])
+    return results
+
+
+def deserialize_items(items):
+    """Convert the cached lists back to the get_submenus() structure."""
+    for item in items:
+        details = item[2]
+        if details is not None and details['icon'] is not None:
+            try:
+                details['icon'] = Gio.Icon.new_for_string(details['icon'])
+            except GLib.Error:
+                details['icon'] = None
+        if item[3] is not None:
+            deserialize_items(item[3])
+    return items
+
+
+def load(basename):
+    """Return the cached (menu_name, structure) for the menu basename, or
+    None if the cache is missing or out of date."""
+    filename = get_cache_filename(basename)
+    if not os.path.isfile(filename):
+        return None
+
+    try:
+        with open(filename, 'r', encoding='utf-8') as cache_file:
+            data = json.load(cache_file)
+        if data.get('version') != CACHE_VERSION:
+            return None
+        if data.get('key') != get_cache_key(basename):
+            logger.debug("Menu cache is out of date: %s" % filename)
+            return None
+        structure = [deserialize_items(items) for items in data['menus']]
+    except (OSError, ValueError, KeyError, TypeError):
+        logger.warning("Failed to read menu cache %s" % filename)
+        return None
+
+    logger.debug("Using menu cache: %s" % filename)
+    return data['menu_name'], structure
+
+
+def save(basename, menu_name, structure):
+    """Store the parsed menu structure for the next launch."""
+    filename = get_cache_filename(basename)
+    data = {
+        'version': CACHE_VERSION,
+        'key': get_cache_key(basename),
+        'menu_name': menu_name,
+        'menus': [serialize_items(items) for items in structure]
+    }
+
+    tmp_filename = "%s.%i.tmp" % (filename, os.getpid())
+    try:
+        with open(tmp_filename, 'w', encoding='utf-8') as cache_file:
+            json.dump(data, cache_file)
+        os.replace(tmp_filename, filename)
+    except (OSError, TypeError, ValueError):
+        logger.warning("Failed to write menu cache %s" % filename)
+        try:
+            os.remove(tmp_filename)
+        except OSError:
+            pass
+        return False
+
+    return True
+
+
+def invalidate(basename=None):
+    """Remove the cached menu structure for basename, or all of them."""
+    cache_dir = util.getUserCacheDirectory()
+    for filename in os.listdir(cache_dir):
+        if not filename.startswith("menu-") or not filename.endswith(".json"):
+            continue
+        if basename is not None and filename != "menu-%s.json" % basename:
+            continue
+        try:
+            os.remove(os.path.join(cache_dir, filename))
+        except OSError:
+            logger.warning("Failed to remove menu cache %s" % filename)
@@ -30,9 +30,10 @@ logger = logging.getLogger('menulibre')  # noqa
 
 import gi
 gi.require_version('GMenu', '3.0')  # noqa
-from gi.repository import Gio, GMenu, Gtk  # type: ignore
+from gi.repository import Gio, GLib, GMenu, Gtk  # type: ignore
 
-from . import util
+from . import MenuCache, util
+from menulibre_lib import timed_phase
 from .util import MenuItemTypes, escapeText, mapDesktopEnvironmentDirectories, unmapDesktopEnvironmentDirectories
 
 locale.textdomain('menulibre')
@@ -84,7 +85,8 @@ def get_icon_theme_name():
     return "Adwaita"
 
 
-icon_theme_name = get_icon_theme_name()
+with timed_phase("icon theme lookup"):
+    icon_theme_name = get_icon_theme_name()
 
 
 menu_name = ""
@@ -121,46 +123,49 @@ def get_default_menu():
     return None
 
 
+def get_item_row(item):
+    """Return the treestore row data for a menu item."""
+    item_type = item[0]
+    if item_type == MenuItemTypes.SEPARATOR:  # type: ignore
+        executable = ""
+        name = _("Separator")
+        displayed_name = name
+        # Translators: Separator menu item
+        tooltip = _("Separator")
+        categories = ""
+        filename = None
+        icon_name = "content-loading-symbolic"
+        icon = Gio.ThemedIcon.new(icon_name)
+        item_type = MenuItemTypes.SEPARATOR  # type: ignore
+        show = False
+    else:
+        executable = item[2]['executable']
+        name = item[2]['display_name']
+        displayed_name = escapeText(name)
+        show = item[2]['show']
+        tooltip = item[2]['comment']
+        categories = item[2]['categories']
+        icon, icon_name = get_item_icon(item_type, item[2])
+        filename = item[2]['filename']
+
+    return [name, displayed_name, tooltip, executable, categories,
+            item_type, icon, icon_name, filename, False, show]
+
+
 def menu_to_treestore(treestore, parent, menu_items):
     """Convert the Alacarte menu to a standard treestore."""
     for item in menu_items:
-        item_type = item[0]
-        if item_type == MenuItemTypes.SEPARATOR:  # type: ignore
-            executable = ""
-            name = _("Separator")
-            displayed_name = name
-            # Translators: Separator menu item
-            tooltip = _("Separator")
-            categories = ""
-            filename = None
-            icon_name = "content-loading-symbolic"
-            icon = Gio.ThemedIcon.new(icon_name)
-            item_type = MenuItemTypes.SEPARATOR  # type: ignore
-            show = False
-        else:
-            executable = item[2]['executable']
-            name = item[2]['display_name']
-            displayed_name = escapeText(name)
-            show = item[2]['show']
-            tooltip = item[2]['comment']
-            categories = item[2]['categories']
-            icon = item[2]['icon']
-            filename = item[2]['filename']
-            icon_name = item[2]['icon_name']
-
-        treeiter = treestore.append(
-            parent, [name, displayed_name, tooltip, executable, categories,
-                     item_type, icon, icon_name, filename, False, show])
-
-        if item_type == MenuItemTypes.DIRECTORY:  # type: ignore
+        treeiter = treestore.append(parent, get_item_row(item))
+
+        if item[0] == MenuItemTypes.DIRECTORY:  # type: ignore
             treestore = menu_to_treestore(treestore, treeiter, item[3])
 
     return treestore
 
 
-def get_treestore():
-    """Get the TreeStore implementation of the current menu."""
-    treestore = Gtk.TreeStore(  # type: ignore
+def get_column_types():
+    """Return the types of the menu columns."""
+    return [
         str,  # Name
         str,  # Displayed Name
         str,  # Comment
@@ -172,11 +177,18 @@ def get_treestore():
         str,  # Filename
         bool,  # Expand
         bool  # Show
-    )
-    menus = get_menus()
-    if not menus:
-        return None
-    return menu_to_treestore(treestore, None, menus[0])
+    ]
+
+
+def new_treestore():
+    """Return an empty TreeStore with the menu columns."""
+    return Gtk.TreeStore(*get_column_types())  # type: ignore
+
+
+def new_liststore():
+    """Return an empty ListStore with the menu columns, used to list search
+    results."""
+    return Gtk.ListStore(*get_column_types())  # type: ignore
 
 
 def get_extended_icons(icon_names, extended_names):
@@ -199,110 +211,237 @@ def get_extended_icons(icon_names, extended_names):
     return results
 
 
+def get_item_icon(item_type, details):
+    """Return the GIcon and icon name to display for a menu item, appending
+    fallback icons from the current theme. This queries the icon theme, so
+    it must be called from the main thread."""
+    icon = details['icon']
+    icon_name = details['icon_name']
+
+    if item_type == MenuItemTypes.DIRECTORY:  # type: ignore
+        extended_icon_names = ["folder"]
+    else:
+        extended_icon_names = [
+            "applications-other",
+            "application-x-executable"]
+
+    icon_names = []
+    if isinstance(icon, Gio.ThemedIcon):
+        icon_names = icon.get_names()
+    elif isinstance(icon, Gio.FileIcon):
+        icon_names = [icon.get_file().get_path()]
+
+    if icon_name is not None:
+        icon_names = [icon_name] + icon_names
+
+    extended = get_extended_icons(icon_names, extended_icon_names)
+    if len(extended) > 0 and isinstance(icon, Gio.ThemedIcon):
+        # Build a new icon, the original may be shared with the menu cache.
+        icon = Gio.ThemedIcon.new_from_names(icon.get_names() + extended)
+    icon_names = icon_names + extended
+
+    if icon_name is None:
+        icon_name = icon_names[0]
+
+    elif icon is None:
+        icon = Gio.ThemedIcon.new(icon_name)
+
+    return icon, icon_name
+
+
+def get_menu_item(menu, child):
+    """Return the [item_type, entry_id, details, submenus] structure for a
+    GMenu tree item, or None if the item is not displayed."""
+    if isinstance(child, GMenu.TreeSeparator):
+        return [MenuItemTypes.SEPARATOR, child, None, None]  # type: ignore
+
+    if isinstance(child, GMenu.TreeEntry):
+        item_type = MenuItemTypes.APPLICATION  # type: ignore
+        entry_id = child.get_desktop_file_id()
+        app_info = child.get_app_info()
+        icon = app_info.get_icon()
+        icon_name = app_info.get_string("Icon")
+        display_name = app_info.get_display_name()
+        generic_name = app_info.get_generic_name()
+        comment = app_info.get_description()
+        keywords = app_info.get_keywords()
+        categories = app_info.get_categories()
+        mime_types = app_info.get_supported_types()
+        executable = app_info.get_executable()
+        filename = child.get_desktop_file_path()
+        submenus = None
+
+        is_hidden = app_info.get_is_hidden()
+        no_display = app_info.get_nodisplay()
+        show_in = app_info.get_show_in()
+        hidden = is_hidden or no_display or not show_in
+
+    elif isinstance(child, GMenu.TreeDirectory):
+        item_type = MenuItemTypes.DIRECTORY  # type: ignore
+        entry_id = child.get_menu_id()
+        icon = child.get_icon()
+        icon_name = None
+        display_name = child.get_name()
+        generic_name = child.get_generic_name()
+        comment = child.get_comment()
+        keywords = []
+        categories = ""
+        mime_types = []
+        executable = None
+        filename = child.get_desktop_file_path()
+        hidden = child.get_is_nodisplay()
+        submenus = get_submenus(menu, child)
+
+    else:
+        return None
+
+    if filename is not None:
+        filename = os.path.realpath(filename)
+
+    details = {'display_name': display_name,
+               'generic_name': generic_name,
+               'comment': comment,
+               'keywords': keywords,
+               'categories': categories,
+               'mime_types': list(mime_types or []),
+               'executable': executable,
+               'filename': filename,
+               'icon': icon,
+               'icon_name': icon_name,
+               'show': not hidden}
+    return [item_type, entry_id, details, submenus]
+
+
+def get_file_item(filename):
+    """Return the [item_type, entry_id, details, submenus] structure for a
+    launcher or directory file read directly from disk, or None if it can't
+    be read. Used to refresh items without reloading the whole menu."""
+    keyfile = GLib.KeyFile.new()
+    try:
+        keyfile.load_from_file(filename, GLib.KeyFileFlags.NONE)
+    except GLib.Error:
+        return None
+
+    def get_string(key, localized=False):
+        try:
+            if localized:
+                return keyfile.get_locale_string("Desktop Entry", key, None)
+            return keyfile.get_string("Desktop Entry", key)
+        except GLib.Error:
+            return None
+
+    def get_boolean(key):
+        try:
+            return keyfile.get_boolean("Desktop Entry", key)
+        except GLib.Error:
+            return False
+
+    if filename.endswith('.directory'):
+        item_type = MenuItemTypes.DIRECTORY  # type: ignore
+        executable = None
+        categories = ""
+    else:
+        item_type = MenuItemTypes.APPLICATION  # type: ignore
+        executable = get_string("Exec")
+        categories = get_string("Categories") or ""
+
+    icon_name = get_string("Icon")
+    icon = None
+    if icon_name is not None:
+        if os.path.isabs(icon_name):
+            icon = Gio.FileIcon.new(Gio.File.new_for_path(icon_name))
+        else:
+            icon = Gio.ThemedIcon.new(icon_name)
+
+    keywords = []
+    try:
+        keywords = keyfile.get_locale_string_list(
+            "Desktop Entry", "Keywords", None)
+    except GLib.Error:
+        pass
+
+    mime_types = []
+    try:
+        mime_types = keyfile.get_string_list("Desktop Entry", "MimeType")
+    except GLib.Error:
+        pass
+
+    if item_type == MenuItemTypes.APPLICATION:  # type: ignore
+        # Match get_menu_item(), which also hides launchers that are not
+        # shown in the current desktop. GMenu skips the launchers that
+        # GDesktopAppInfo can't load, so keep those hidden too.
+        app_info = Gio.DesktopAppInfo.new_from_filename(filename)
+        if app_info is None:
+            hidden = True
+        else:
+            hidden = app_info.get_is_hidden() or app_info.get_nodisplay() or \
+                not app_info.get_show_in()
+    else:
+        hidden = get_boolean("Hidden") or get_boolean("NoDisplay")
+    details = {'display_name': get_string("Name", True) or "",
+               'generic_name': get_string("GenericName", True),
+               'comment': get_string("Comment", True),
+               'keywords': keywords,
+               'categories': categories,
+               'mime_types': mime_types,
+               'executable': executable,
+               'filename': os.path.realpath(filename),
+               'icon': icon,
+               'icon_name': icon_name,
+               'show': not hidden}
+    return [item_type, util.getRelativeName(filename), details, None]
+
+
 def get_submenus(menu, tree_dir):
     """Get the submenus for a tree directory."""
     structure = []
     for child in menu.getContents(tree_dir):
-        if isinstance(child, GMenu.TreeSeparator):
-            structure.append([MenuItemTypes.SEPARATOR, child, None, None])  # type: ignore
-        else:
-            if isinstance(child, GMenu.TreeEntry):
-                item_type = MenuItemTypes.APPLICATION  # type: ignore
-                entry_id = child.get_desktop_file_id()
-                app_info = child.get_app_info()
-                icon = app_info.get_icon()
-                icon_name = app_info.get_string("Icon")
-                extended_icon_names = [
-                    "applications-other",
-                    "application-x-executable"]
-                display_name = app_info.get_display_name()
-                generic_name = app_info.get_generic_name()
-                comment = app_info.get_description()
-                keywords = app_info.get_keywords()
-                categories = app_info.get_categories()
-                executable = app_info.get_executable()
-                filename = child.get_desktop_file_path()
-                submenus = None
-
-                is_hidden = app_info.get_is_hidden()
-                no_display = app_info.get_nodisplay()
-                show_in = app_info.get_show_in()
-                hidden = is_hidden or no_display or not show_in
-
-            elif isinstance(child, GMenu.TreeDirectory):
-                item_type = MenuItemTypes.DIRECTORY  # type: ignore
-                entry_id = child.get_menu_id()
-                icon = child.get_icon()
-                icon_name = None
-                extended_icon_names = ["folder"]
-                display_name = child.get_name()
-                generic_name = child.get_generic_name()
-                comment = child.get_comment()
-                keywords = []
-                categories = ""
-                executable = None
-                filename = child.get_desktop_file_path()
-                hidden = child.get_is_nodisplay()
-                submenus = get_submenus(menu, child)
-
-            else:
-                continue
-
-            icon_names = []
-            if isinstance(icon, Gio.ThemedIcon):
-                icon_names = icon.get_names()
-            elif isinstance(icon, Gio.FileIcon):
-                icon_names = [icon.get_file().get_path()]
-
-            if icon_name is not None:
-                icon_names = [icon_name] + icon_names
-
-            for extended_icon_name in get_extended_icons(
-                    icon_names, extended_icon_names):
-                if isinstance(icon, Gio.ThemedIcon):
-                    icon.append_name(extended_icon_name)
-                icon_names.append(extended_icon_name)
-
-            if icon_name is None:
-                icon_name = icon_names[0]
-
-            elif icon is None:
-                icon = Gio.ThemedIcon.new(icon_name)
-
-            if filename is not None:
-                filename = os.path.realpath(filename)
-
-            details = {'display_name': display_name,
-                       'generic_name': generic_name,
-                       'comment': comment,
-                       'keywords': keywords,
-                       'categories': categories,
-                       'executable': executable,
-                       'filename': filename,
-                       'icon': icon,
-                       'icon_name': icon_name,
-                       'show': not hidden}
-            entry = [item_type, entry_id, details, submenus]
+        entry = get_menu_item(menu, child)
+        if entry is not None:
             structure.append(entry)
-
     return structure
 
 
-def get_menus():
-    """Get the menus from the MenuEditor"""
-    menu = MenuEditor()
+def iter_menus():
+    """Yield the toplevel menu items one at a time, from the on-disk cache if
+    none of the menu sources have changed since it was written. Nothing is
+    yielded if the menu cannot be loaded.
+
+    GTK is not used here, so this is safe to run in a worker thread."""
+    global menu_name
+    basename = get_default_menu()
+    if basename is None:
+        return
+
+    with timed_phase("menu cache load"):
+        cached = MenuCache.load(basename)
+    if cached is not None:
+        menu_name, structure = cached
+        for items in structure:
+            yield from items
+        return
+
+    with timed_phase("menu tree load"):
+        menu = MenuEditor(basename)
     if not menu.loaded:
-        return None
+        return
     structure = []
-    toplevels = []
-    global menu_name
     menu_name = menu.tree.get_root_directory().get_menu_id()
-    for child in menu.getMenus(None):
-        toplevels.append(child)
-    for top in toplevels:
-        structure.append(get_submenus(menu, top[0]))
+    for top in list(menu.getMenus(None)):
+        items = []
+        for child in menu.getContents(top[0]):
+            with timed_phase("get submenus"):
+                entry = get_menu_item(menu, child)
+            if entry is not None:
+                items.append(entry)
+                yield entry
+        structure.append(items)
     menu.unmap()
-    return structure
+
+    # The cache key is computed after unmapping so that it matches the state
+    # of the desktop-directories on the next launch.
+    with timed_phase("menu cache save"):
+        MenuCache.save(basename, menu_name, structure)
 
 
 def removeWhitespaceNodes(node):
@@ -378,7 +517,9 @@ class MenuEditor(object):
 
     def load(self):
         """load"""
-        if not self.tree.load_sync():
+        with timed_phase("GMenu.Tree.load_sync"):
+            loaded = self.tree.load_sync()
+        if not loaded:
             raise ValueError("can not load menu tree %r" %
                              (self.tree.props.menu_basename,))
 
@@ -17,18 +17,19 @@
 #   with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-from .util import getCurrentDesktop, getProcessList
+from .util import getCurrentDesktop, findProcesses, getSessionProcesses
 from .util import MenuItemTypes, check_keypress, getRelativeName, getRelatedKeys
 from .Headerbar import Headerbar
 from .Toolbar import Toolbar
 from .ApplicationEditor import ApplicationEditor
 from .CategoryEditor import category_lookup
-from . import MenuEditor
-from . import MenulibreXdg, util, ParsingErrorsDialog
+from . import MenuCache, MenuEditor
+from . import MenulibreXdg, MenulibreValidator, util, ParsingErrorsDialog
 from . import MenulibreTreeview, MenulibreHistory, Dialogs
 import os
 import shlex
 import sys
+import threading
 
 import subprocess
 import tempfile
@@ -39,6 +40,8 @@ from gi import require_version
 require_version('Gtk', '3.0')
 from gi.repository import Gio, GLib, GObject, Gtk, Gdk  # type: ignore
 
+from menulibre_lib import timed_phase, mark_time, write_timing_report
+
 
 logger = logging.getLogger('menulibre')
 
@@ -68,6 +71,10 @@ class MenulibreWindow(Gtk.ApplicationWindow):
 
         self.action_items = dict()
 
+        # Kept for the startup report, the window may already be detached
+        # from the application when it is destroyed.
+        self.app = app
+
         # Set up History
         self.history = MenulibreHistory.History()
         self.history.connect('undo-changed', self.on_undo_changed)
@@ -105,18 +112,28 @@ class MenulibreWindow(Gtk.ApplicationWindow):
         # Set up the application browser
         self.configure_application_treeview()
 
-        # Determining paths of bad desktop files GMenu can't load - if some are
-        # detected, alerting user via InfoBar
-        self.bad_desktop_files = util.determine_bad_desktop_files()
-        if self.bad_desktop_files:
-            self.configure_application_bad_desktop_files_infobar()
+        # Bad desktop files are detected in the background once the menu has
+        # loaded, see start_bad_desktop_files_detection()
+        self.bad_desktop_files = []
+        self.bad_desktop_files_cancellable = None
+
+        # Startup timings are reported once the window has been drawn and the
+        # menu has loaded, see finish_startup_phase()
+        self.startup_phases = set(['first-paint', 'menu-loaded'])
+        self.draw_handler_id = self.connect('draw', self.on_window_first_draw)
 
         self.configure_menu_restart_infobar()
 
+        # Actions requiring the complete menu are disabled until it has loaded
+        self.set_loading(True)
+
         self.show_all()
 
         self.on_apps_browser_cursor_changed(None, None)
 
+        # Load the menu in the background, the tree is filled in as it loads.
+        self.treeview.load()
+
     def connect_toolbar(self):
         self.insert_action_item('add_button', self.add_button)
 
@@ -269,6 +286,7 @@ class MenulibreWindow(Gtk.ApplicationWindow):
         # Connect any window-specific events.
         self.connect('key-press-event', self.on_window_keypress_event)
         self.connect('delete-event', self.on_window_delete_event)
+        self.connect('destroy', self.on_window_destroy)
 
     def configure_css(self):
         screen = Gdk.Screen.get_default()
@@ -556,12 +574,11 @@ class MenulibreWindow(Gtk.ApplicationWindow):
     def configure_application_treeview(self):
         """Configure the menu-browsing GtkTreeView."""
         self.treeview = MenulibreTreeview.Treeview(self)
-        if not self.treeview.loaded:
-            self.menu_load_failure()
 
         self.panes.add(self.treeview)
 
-        self.editor = ApplicationEditor(use_headerbar=self.use_headerbar)
+        with timed_phase("construct editor"):
+            self.editor = ApplicationEditor(use_headerbar=self.use_headerbar)
         self.panes.add(self.editor)
 
         self.treeview.set_search_entry(self.search_box)
@@ -573,10 +590,38 @@ class MenulibreWindow(Gtk.ApplicationWindow):
                               self.on_apps_browser_add_directory_enabled)
         self.treeview.connect("requires-menu-reload",
                               self.on_apps_browser_requires_menu_reload)
-        self.treeview.reset_cursor()
+        self.treeview.connect("loaded", self.on_apps_browser_loaded)
 
         self.editor.connect("value-changed", self.on_smart_widget_changed)
 
+    def set_loading(self, loading):
+        """Disable actions that require the complete menu while it is being
+        loaded."""
+        self.loading = loading
+        self.set_actions_enabled(['add_launcher', 'add_directory',
+                                  'add_separator', 'add_button'],
+                                 not loading)
+        self.search_box.set_sensitive(not loading)
+        self.editor.set_sensitive(not loading)
+        if loading:
+            for name in ['save_launcher', 'revert', 'execute', 'delete']:
+                for widget in self.action_items[name]:
+                    widget.set_sensitive(False)
+
+    def set_actions_enabled(self, names, enabled):
+        """Set the sensitivity of the named actions and their widgets."""
+        for name in names:
+            if name in self.action_items:
+                for widget in self.action_items[name]:
+                    widget.set_sensitive(enabled)
+            if name in self.actions:
+                self.actions[name].set_sensitive(enabled)
+                self.emit('action-enabled', name, enabled)
+
+    def get_has_unsaved_changes(self):
+        """Return True if the current launcher has unsaved changes."""
+        return self.save_button.get_sensitive()
+
     def get_can_select(self):
         if self.save_button.get_sensitive():
             dialog = Dialogs.SaveOnLeaveDialog(self, self.use_headerbar)
@@ -690,22 +735,81 @@ class MenulibreWindow(Gtk.ApplicationWindow):
             if response == Gtk.ResponseType.CANCEL:
                 return True
             # Don't Save allows the application to close.
-            elif response == Gtk.ResponseType.NO:
-                return False
-            # Save and close.
-            else:
+            elif response != Gtk.ResponseType.NO:
+                # Save and close.
                 self.save_launcher()
-                return False
+        # Write the menu changes still waiting for the delayed write.
+        self.treeview.flush_menus()
+        return False
+
+    def on_window_first_draw(self, widget, cr):
+        """Record the first paint of the window."""
+        self.disconnect(self.draw_handler_id)
+        self.finish_startup_phase('first-paint')
         return False
 
+    def finish_startup_phase(self, name):
+        """Mark a startup phase as finished. Once they all are, write the
+        startup timings if they were requested on the command line."""
+        if name not in self.startup_phases:
+            return
+        mark_time(name)
+        self.startup_phases.remove(name)
+        if len(self.startup_phases) > 0:
+            return
+        self.write_startup_report()
+
+    def write_startup_report(self):
+        """Write the startup timings recorded so far, if they were requested
+        on the command line."""
+        app = self.app
+        if not app.profile_startup:
+            return
+        try:
+            write_timing_report(app.profile_output)
+        except OSError:
+            logger.warning("Failed to write the startup timings to %s" %
+                           app.profile_output)
+
+    def on_window_destroy(self, widget):
+        """Stop any background jobs when the window is closed."""
+        if self.bad_desktop_files_cancellable is not None:
+            self.bad_desktop_files_cancellable.cancel()
+        self.treeview.stop_monitoring()
+
+        # Closed before startup finished, report what was recorded.
+        if len(self.startup_phases) > 0:
+            self.startup_phases.clear()
+            self.write_startup_report()
 
 # Applications Treeview
 
+    def on_apps_browser_loaded(self, widget, loaded):
+        """Enable editing once the menu has finished loading."""
+        if not loaded:
+            # Report the timings up to the failure, the remaining phases
+            # will never finish.
+            mark_time('menu-load-failed')
+            self.startup_phases.clear()
+            self.write_startup_report()
+            self.menu_load_failure()
+            return
+
+        self.set_loading(False)
+        self.treeview.reset_cursor()
+        self.on_apps_browser_cursor_changed(None, None)
+        self.finish_startup_phase('menu-loaded')
+
+        self.start_bad_desktop_files_detection()
+
     def on_apps_browser_requires_menu_reload(self, widget, required):
+        # Read the menu again from GMenu on the next start.
+        MenuCache.invalidate()
         self.menu_restart_infobar.show()
 
     def on_menu_restart_button_activate(self, widget):
-        processes = getProcessList()
+        # Check again, the panel may have been replaced since startup
+        processes = findProcesses(util.SESSION_PROCESSES)
         if "mate-panel" in processes:
             cmd = ["mate-panel", "--replace"]
         elif "xfce4-panel" in processes:
@@ -835,22 +939,24 @@ class MenulibreWindow(Gtk.ApplicationWindow):
 
                 if item_type == MenuItemTypes.APPLICATION:  # type: ignore
                     self.editor.show_all()
-                    entry = MenulibreXdg.MenulibreDesktopEntry(filename)
-                    for key in getRelatedKeys(item_type, key_only=True):
+                    entry = MenulibreXdg.get_desktop_entry(filename)
+                    for key, key_type, required in getRelatedKeys(item_type):
                         if key in ['Actions', 'Comment', 'Filename', 'Icon',
                                    'Name']:
                             continue
-                        self.set_value(key, entry[key], store=True)
+                        self.set_value(key, self.get_entry_value(
+                            entry, key, key_type), store=True)
                     self.set_value('Actions', entry.get_actions(),
                                    store=True)
                     self.set_value('Type', 'Application')
                     self.execute_button.set_sensitive(True)
                 else:
-                    entry = MenulibreXdg.MenulibreDesktopEntry(filename)
-                    for key in getRelatedKeys(item_type, key_only=True):
+                    entry = MenulibreXdg.get_desktop_entry(filename)
+                    for key, key_type, required in getRelatedKeys(item_type):
                         if key in ['Comment', 'Filename', 'Icon', 'Name']:
                             continue
-                        self.set_value(key, entry[key], store=True)
+                        self.set_value(key, self.get_entry_value(
+                            entry, key, key_type), store=True)
                     self.set_value('Type', 'Directory')
                     self.execute_button.set_sensitive(False)
 
@@ -902,14 +1008,8 @@ class MenulibreWindow(Gtk.ApplicationWindow):
             self.treeview.set_searchable(False, expand)
 
             # Enable add functionality
-            for name in ['add_launcher', 'add_directory', 'add_separator',
-                         'add_button']:
-                if name in self.action_items:
-                    for widget in self.action_items[name]:
-                        widget.set_sensitive(True)
-                if name in self.actions:
-                    self.actions[name].set_sensitive(True)
-                    self.emit('action-enabled', name, True)
+            self.set_actions_enabled(['add_launcher', 'add_directory',
+                                      'add_separator', 'add_button'], True)
 
             # Enable deletion (LP: #1751616)
             # self.delete_button.set_sensitive(True)
@@ -924,14 +1024,8 @@ class MenulibreWindow(Gtk.ApplicationWindow):
             self.treeview.set_searchable(True)
 
             # Disable add functionality
-            for name in ['add_launcher', 'add_directory', 'add_separator',
-                         'add_button']:
-                if name in self.action_items:
-                    for widget in self.action_items[name]:
-                        widget.set_sensitive(False)
-                if name in self.actions:
-                    self.actions[name].set_sensitive(False)
-                    self.emit('action-enabled', name, False)
+            self.set_actions_enabled(['add_launcher', 'add_directory',
+                                      'add_separator', 'add_button'], False)
 
             # Rerun the filter.
             self.treeview.search(self.search_box.get_text())
@@ -1140,7 +1234,9 @@ class MenulibreWindow(Gtk.ApplicationWindow):
                 values.append(value)
         return values
 
-    def write_launcher(self, filename):  # noqa
+    def write_launcher(self, filename, notify=True):  # noqa
+        """Write the launcher to filename. If notify is True and the contents
+        changed, the desktop menu is updated with the next menu write."""
         keyfile = GLib.KeyFile.new()
 
         for key, ktype, required in getRelatedKeys(self.get_value("Type")):
@@ -1175,12 +1271,15 @@ class MenulibreWindow(Gtk.ApplicationWindow):
                 if len(value) > 0:
                     keyfile.set_string_list("Desktop Entry", key, value)
 
+        created = not os.path.exists(filename)
         try:
-            if not keyfile.save_to_file(filename):
-                return False
-        except GLib.Error:
+            written = util.writeFileAtomic(filename, keyfile.to_data()[0])
+        except OSError:
             return False
 
+        if written and notify:
+            self.treeview.notify_files_changed(created)
+
         return True
 
     def save_launcher(self, temp=False):  # noqa
@@ -1228,7 +1327,7 @@ class MenulibreWindow(Gtk.ApplicationWindow):
             # Cleanup invalid entries and reorder the Categories and Actions
             self.cleanup_actions()
 
-        if not self.write_launcher(filename):
+        if not self.write_launcher(filename, notify=not temp):
             dlg = Dialogs.SaveErrorDialog(self, filename, self.use_headerbar)
             dlg.run()
             return False
@@ -1242,6 +1341,9 @@ class MenulibreWindow(Gtk.ApplicationWindow):
         # Set the editor to the new filename.
         self.set_value('Filename', filename)
 
+        # Search the saved keywords and generic name.
+        self.treeview.update_search_details(filename)
+
         # Update the selected iter with the new details.
         name = self.get_value('Name')
         comment = self.get_value('Comment')
@@ -1272,7 +1374,7 @@ class MenulibreWindow(Gtk.ApplicationWindow):
         self.update_launcher_category_dirs()
 
         if filename.endswith(".directory"):
-            processes = getProcessList()
+            processes = getSessionProcesses()
             if "mate-panel" in processes:
                 self.menu_restart_infobar.show()
 
@@ -1288,10 +1390,10 @@ class MenulibreWindow(Gtk.ApplicationWindow):
                                              item_type, force_update=True)
         logger.debug("Saving launcher as \"%s\"" % save_filename)
 
-        # Get the original contents
-        keyfile = GLib.KeyFile.new()
-        keyfile.load_from_file(original_filename,  # type: ignore
-                               GLib.KeyFileFlags.NONE)
+        # Get the original contents. The parsed entry is changed below, so it
+        # is taken out of the cache.
+        keyfile = MenulibreXdg.get_desktop_entry(original_filename).keyfile
+        MenulibreXdg.desktop_entry_cache.invalidate(original_filename)
 
         try:
             categories = keyfile.get_string_list("Desktop Entry", "Categories")
@@ -1323,7 +1425,13 @@ class MenulibreWindow(Gtk.ApplicationWindow):
 
         # Commit the changes to a new file
         keyfile.set_string_list("Desktop Entry", "Categories", categories)
-        keyfile.save_to_file(save_filename)
+        created = not os.path.exists(save_filename)
+        try:
+            if util.writeFileAtomic(save_filename, keyfile.to_data()[0]):
+                self.treeview.notify_files_changed(created)
+        except OSError:
+            logger.warning("Failed to write %s" % save_filename)
+            return
 
         # Set the editor to the new filename.
         self.set_value('Filename', save_filename)
@@ -1510,6 +1618,13 @@ class MenulibreWindow(Gtk.ApplicationWindow):
                 return piece
         return False
 
+    def get_entry_value(self, entry, key, key_type):
+        """Return the value of a desktop entry key for the editor. Boolean
+        keys are read with the typed getter."""
+        if key_type is bool:
+            return entry.get_boolean("Desktop Entry", key)
+        return entry[key]
+
     def on_execute_cb(self, widget):
         """Execute callback function."""
         self.editor.commit()
@@ -1576,6 +1691,36 @@ class MenulibreWindow(Gtk.ApplicationWindow):
         GtkApplication instance."""
         self.emit('about', True)
 
+    def start_bad_desktop_files_detection(self):
+        """Validate the installed desktop files in a worker thread. If some
+        are detected, the user is alerted via an InfoBar."""
+        if self.bad_desktop_files_cancellable is not None:
+            self.bad_desktop_files_cancellable.cancel()
+        cancellable = Gio.Cancellable.new()
+        self.bad_desktop_files_cancellable = cancellable
+
+        thread = threading.Thread(target=self.bad_desktop_files_worker,
+                                  args=(cancellable,), daemon=True)
+        thread.start()
+
+    def bad_desktop_files_worker(self, cancellable):
+        """Worker thread for start_bad_desktop_files_detection()."""
+        bad_desktop_files = MenulibreValidator.find_bad_desktop_files(
+            cancellable)
+        if not cancellable.is_cancelled():
+            GLib.idle_add(self.on_bad_desktop_files_detected,
+                          bad_desktop_files, cancellable)
+
+    def on_bad_desktop_files_detected(self, bad_desktop_files, cancellable):
+        """Report the results of the background detection."""
+        if cancellable.is_cancelled():
+            return False
+        self.bad_desktop_files_cancellable = None
+        self.bad_desktop_files = bad_desktop_files
+        if self.bad_desktop_files:
+            self.configure_application_bad_desktop_files_infobar()
+        return False
+
     def on_bad_desktop_files_infobar_response(self, infobar, response_id):
         """Bad desktop files infobar callback function to request the bad
         desktop files report if desired."""
@@ -1597,9 +1742,7 @@ class MenulibreWindow(Gtk.ApplicationWindow):
 
         # Building up a list of all known failures associated with the bad
         # desktop files
-        for desktop_file in self.bad_desktop_files:
-            log_dialog.add_item(desktop_file,
-                                util.validate_desktop_file(desktop_file))
+        log_dialog.add_results(self.bad_desktop_files)
 
         log_dialog.run()
         log_dialog.destroy()
@@ -1613,27 +1756,57 @@ class Application(Gtk.Application):
         Gtk.Application.__init__(self)
         self.use_headerbar = False
         self.use_toolbar = False
+        self.profile_startup = False
+        self.profile_output = None
 
         self.settings_file = os.path.expanduser("~/.config/menulibre.cfg")
 
-    def set_use_headerbar(self, preference):
+    def set_boolean_setting(self, key, value):
+        """Save a boolean preference, keeping the other preferences."""
         try:
             settings = GLib.KeyFile.new()
-            settings.set_boolean("menulibre", "UseHeaderbar", preference)
+            if os.path.exists(self.settings_file):
+                settings.load_from_file(self.settings_file,
+                                        GLib.KeyFileFlags.KEEP_COMMENTS)
+            settings.set_boolean("menulibre", key, value)
             settings.save_to_file(self.settings_file)
         except:  # noqa
             pass
 
-    def get_use_headerbar(self):
+    def get_integer_setting(self, key):
+        """Return an integer preference, or None if it is not set."""
         if not os.path.exists(self.settings_file):
             return None
         try:
             settings = GLib.KeyFile.new()
             settings.load_from_file(self.settings_file, GLib.KeyFileFlags.NONE)
-            return settings.get_boolean("menulibre", "UseHeaderbar")
+            return settings.get_integer("menulibre", key)
         except:  # noqa
             return None
 
+    def get_boolean_setting(self, key):
+        """Return a boolean preference, or None if it is not set."""
+        if not os.path.exists(self.settings_file):
+            return None
+        try:
+            settings = GLib.KeyFile.new()
+            settings.load_from_file(self.settings_file, GLib.KeyFileFlags.NONE)
+            return settings.get_boolean("menulibre", key)
+        except:  # noqa
+            return None
+
+    def set_use_headerbar(self, preference):
+        self.set_boolean_setting("UseHeaderbar", preference)
+
+    def get_use_headerbar(self):
+        return self.get_boolean_setting("UseHeaderbar")
+
+    def set_search_ranked(self, preference):
+        self.set_boolean_setting("SearchResultsList", preference)
+
+    def get_search_ranked(self):
+        return self.get_boolean_setting("SearchResultsList") is True
+
     def do_activate(self):
         """Handle GtkApplication do_activate."""
         if self.use_toolbar:
@@ -1649,7 +1822,13 @@ class Application(Gtk.Application):
         else:
             headerbar = False
 
-        self.win = MenulibreWindow(self, headerbar)  # type: ignore
+        with timed_phase("construct window"):
+            self.win = MenulibreWindow(self, headerbar)  # type: ignore
+        self.win.treeview.set_search_ranked(self.get_search_ranked())
+        delay = self.get_integer_setting("MenuWriteDelay")
+        if delay is not None:
+            self.win.treeview.set_menu_write_delay(
+                delay, self.get_integer_setting("MenuWriteMaxLatency"))
         self.win.show()
 
         self.win.connect('about', self.about_cb)
@@ -1667,6 +1846,9 @@ class Application(Gtk.Application):
         # Translators: Menu item to open the Parsing Errors dialog.
         section_1_menu.append(_("Parsing Error Log"),
                               "app.bad_files")
+        # Translators: Menu item to list search results by relevance.
+        section_1_menu.append(_("Rank Search Results"),
+                              "app.search_ranked")
         self.menu.append_section(None, section_1_menu)
 
         section_2_menu = Gio.Menu()
@@ -1682,6 +1864,13 @@ class Application(Gtk.Application):
         bad_files_action.connect("activate", self.bad_files_cb)
         self.add_action(bad_files_action)
 
+        # Search results as a ranked list instead of a filtered tree
+        search_ranked_action = Gio.SimpleAction.new_stateful(
+            "search_ranked", None,
+            GLib.Variant.new_boolean(self.get_search_ranked()))
+        search_ranked_action.connect("change-state", self.search_ranked_cb)
+        self.add_action(search_ranked_action)
+
         help_action = Gio.SimpleAction.new("help", None)
         help_action.connect("activate", self.help_cb)
         self.add_action(help_action)
@@ -1715,9 +1904,17 @@ class Application(Gtk.Application):
         # This state is normally tracked with the MenulibreWindow, so not
         # keeping it in this application object. By the time this is called,
         # self.win is valid
-        self.win.bad_desktop_files = util.determine_bad_desktop_files()
+        self.win.bad_desktop_files = \
+            MenulibreValidator.find_bad_desktop_files()
         self.win.bad_desktop_files_report_dialog()
 
+    def search_ranked_cb(self, action, value):
+        """Toggle between filtered and ranked search results."""
+        action.set_state(value)
+        ranked = value.get_boolean()
+        self.set_search_ranked(ranked)
+        self.win.treeview.set_search_ranked(ranked)
+
     def help_cb(self, widget, data=None):
         """Help callback function."""
         dialog = Dialogs.HelpDialog(self.win, self.win.use_headerbar)
@@ -1730,6 +1927,7 @@ class Application(Gtk.Application):
 
     def quit_cb(self, widget, data=None):
         """Signal handler for closing the MenulibreWindow."""
+        self.win.treeview.flush_menus()
         self.quit()
 
     def action_cb(self, widget, data=None, action_name=None):
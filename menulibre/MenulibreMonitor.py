@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+#   MenuLibre - Advanced fd.o Compliant Menu Editor
+#   Copyright (C) 2012-2024 Sean Davis <sean@bluesabre.org>
+#
+#   This program is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License version 3, as published
+#   by the Free Software Foundation.
+#
+#   This program is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranties of
+#   MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+#   PURPOSE.  See the GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+from gi.repository import Gio, GLib, GObject  # type: ignore
+
+from . import util
+
+import logging
+logger = logging.getLogger('menulibre')
+
+
+# Milliseconds to wait after the first event before reporting the changes, so
+# that a package install touching many files is applied as a single batch.
+COALESCE_TIMEOUT = 500
+
+WATCHED_EVENTS = [
+    Gio.FileMonitorEvent.CHANGES_DONE_HINT,
+    Gio.FileMonitorEvent.CREATED,
+    Gio.FileMonitorEvent.DELETED,
+    Gio.FileMonitorEvent.MOVED_IN,
+    Gio.FileMonitorEvent.MOVED_OUT,
+    Gio.FileMonitorEvent.RENAMED,
+]
+
+
+class MenuMonitor(GObject.GObject):
+    """Watch the launcher and directory search paths for changes made outside
+    of menulibre. The relative names of the changed files (as returned by
+    util.getRelativeName) are reported in batches with the changed signal."""
+
+    __gsignals__ = {
+        'changed': (GObject.SIGNAL_RUN_LAST, GObject.TYPE_NONE,
+                    (GObject.TYPE_PYOBJECT,)),
+    }
+
+    def __init__(self):
+        """Initialize the MenuMonitor object."""
+        GObject.GObject.__init__(self)
+        self._monitors = {}
+        self._pending = set()
+        self._timeout_id = 0
+
+    def start(self):
+        """Start watching the search paths."""
+        self.stop()
+
+        paths = [util.getUserApplicationsDirectory()]
+        paths += util.getItemSearchPaths()
+        for path in paths:
+            # Monitors are not recursive, watch each subdirectory too.
+            self._add_tree_monitors(path, path)
+
+        paths = [util.getUserDirectoriesDirectory()]
+        paths += util.getDirectorySearchPaths()
+        for path in paths:
+            if os.path.isdir(path):
+                self._add_monitor(path, path)
+
+        logger.debug("Watching %i directories for menu changes" %
+                     len(self._monitors))
+
+    def stop(self):
+        """Stop watching and discard any changes not yet reported."""
+        for monitor in self._monitors.values():
+            monitor.cancel()
+        self._monitors = {}
+        self._pending.clear()
+        if self._timeout_id > 0:
+            GLib.source_remove(self._timeout_id)
+            self._timeout_id = 0
+
+    def _add_monitor(self, root, path, recursive=False):
+        """Watch a single directory, reporting names relative to root. If
+        recursive, subdirectories created later are watched too."""
+        if path in self._monitors:
+            return
+        try:
+            monitor = Gio.File.new_for_path(path).monitor_directory(
+                Gio.FileMonitorFlags.WATCH_MOVES, None)
+        except GLib.Error:
+            logger.warning("Unable to watch %s for changes" % path)
+            return
+        monitor.connect('changed', self._on_monitor_changed, root, recursive)
+        self._monitors[path] = monitor
+
+    def _add_tree_monitors(self, root, path):
+        """Watch path and each of its subdirectories. Return the launcher
+        and directory files found below path, relative to root."""
+        basenames = []
+        for dirpath, dirnames, filenames in os.walk(path):
+            self._add_monitor(root, dirpath, True)
+            for filename in filenames:
+                basename = self._get_relative_name(
+                    root, os.path.join(dirpath, filename))
+                if basename is not None:
+                    basenames.append(basename)
+        return basenames
+
+    def _remove_tree_monitors(self, path):
+        """Stop watching a removed directory and its subdirectories, so
+        they are watched again if they are recreated."""
+        for watched in list(self._monitors.keys()):
+            if watched == path or watched.startswith(path + os.sep):
+                self._monitors.pop(watched).cancel()
+
+    def _on_monitor_changed(self, monitor, gfile, other_file, event_type,
+                            root, recursive):
+        """Queue the files affected by a file monitor event."""
+        if event_type not in WATCHED_EVENTS:
+            return
+        for changed in [gfile, other_file]:
+            if changed is None:
+                continue
+            # Watch new subdirectories, along with any files already copied
+            # into them before the monitor was added.
+            path = changed.get_path()
+            if recursive and path is not None and os.path.isdir(path) and \
+                    event_type in [Gio.FileMonitorEvent.CREATED,
+                                   Gio.FileMonitorEvent.MOVED_IN,
+                                   Gio.FileMonitorEvent.RENAMED]:
+                self._pending.update(self._add_tree_monitors(root, path))
+                continue
+            if path in self._monitors and path != root and \
+                    not os.path.isdir(path):
+                self._remove_tree_monitors(path)
+            basename = self._get_relative_name(root, path)
+            if basename is not None:
+                self._pending.add(basename)
+
+        if len(self._pending) > 0 and self._timeout_id == 0:
+            self._timeout_id = GLib.timeout_add(COALESCE_TIMEOUT,
+                                                self._on_timeout)
+
+    def _get_relative_name(self, root, filename):
+        """Return the name of filename relative to the search path, or None
+        if it is not a launcher or directory file."""
+        if filename is None:
+            return None
+        if not filename.endswith('.desktop') and \
+                not filename.endswith('.directory'):
+            return None
+        return os.path.relpath(filename, root)
+
+    def _on_timeout(self):
+        """Report the queued changes."""
+        self._timeout_id = 0
+        basenames = sorted(self._pending)
+        self._pending.clear()
+        if len(basenames) > 0:
+            logger.debug("Menu files changed: %s" % ", ".join(basenames))
+            self.emit('changed', basenames)
+        return False
@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+#   MenuLibre - Advanced fd.o Compliant Menu Editor
+#   Copyright (C) 2012-2024 Sean Davis <sean@bluesabre.org>
+#
+#   This program is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License version 3, as published
+#   by the Free Software Foundation.
+#
+#   This program is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranties of
+#   MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+#   PURPOSE.  See the GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import GLib  # type: ignore
+
+import logging
+logger = logging.getLogger('menulibre')
+
+
+# Milliseconds to wait for more changes before writing.
+WRITE_DELAY = 1000
+
+# Milliseconds a change may wait while more changes keep arriving.
+WRITE_MAX_LATENCY = 5000
+
+
+class WriteScheduler:
+    """Batches changes into a single write. The callback is run once no
+    changes have been scheduled for delay milliseconds, but no later than
+    max_latency milliseconds after the first change that has not been
+    written, so a steady stream of edits is still saved. flush() writes any
+    pending changes immediately."""
+
+    def __init__(self, callback, delay=WRITE_DELAY,
+                 max_latency=WRITE_MAX_LATENCY):
+        """Initialize the WriteScheduler with the function to run."""
+        self.callback = callback
+        self.delay = delay
+        self.max_latency = max_latency
+        self._timeout_id = 0
+        self._first_change = None
+
+    def set_delay(self, delay, max_latency=None):
+        """Set the delay, and optionally the maximum latency, in
+        milliseconds. Applies from the next scheduled change."""
+        self.delay = max(0, delay)
+        if max_latency is not None:
+            self.max_latency = max(0, max_latency)
+
+    def get_pending(self):
+        """Return True if there are changes waiting to be written."""
+        return self._first_change is not None
+
+    def schedule(self):
+        """Write after the delay, restarting it if a write is pending."""
+        now = GLib.get_monotonic_time() // 1000
+        if self._first_change is None:
+            self._first_change = now
+        deadline = self._first_change + max(self.max_latency, self.delay)
+        wait = max(0, min(self.delay, deadline - now))
+
+        if self._timeout_id > 0:
+            GLib.source_remove(self._timeout_id)
+        self._timeout_id = GLib.timeout_add(wait, self._on_timeout)
+
+    def cancel(self):
+        """Discard the pending changes without writing them."""
+        if self._timeout_id > 0:
+            GLib.source_remove(self._timeout_id)
+            self._timeout_id = 0
+        self._first_change = None
+
+    def flush(self):
+        """Write the pending changes now, if any."""
+        if not self.get_pending():
+            return
+        self.cancel()
+        logger.debug("Writing pending menu changes")
+        self.callback()
+
+    def _on_timeout(self):
+        """Write the pending changes."""
+        self._timeout_id = 0
+        self._first_change = None
+        self.callback()
+        return False
@@ -0,0 +1,311 @@
+#!/usr/bin/python3
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+#   MenuLibre - Advanced fd.o Compliant Menu Editor
+#   Copyright (C) 2012-2024 Sean Davis <sean@bluesabre.org>
+#
+#   This program is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License version 3, as published
+#   by the Free Software Foundation.
+#
+#   This program is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranties of
+#   MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+#   PURPOSE.  See the GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from .util import MenuItemTypes
+
+import os
+
+import logging
+logger = logging.getLogger('menulibre')
+
+
+# Separates the fields of a document so that a query never matches across
+# two of them.
+FIELD_SEPARATOR = "\0"
+
+# Relative importance of each field when ranking launchers, in the order of
+# the feature vector.
+FIELD_WEIGHTS = (1.0, 0.6, 0.5, 0.4)
+
+
+def get_trigrams(text):
+    """Return the set of three character substrings of text."""
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+def get_command_name(executable):
+    """Return the program name from an Exec command line."""
+    if not executable or len(executable.split()) == 0:
+        return ""
+    return os.path.basename(executable.split()[0].strip("\"'"))
+
+
+def get_field_score(query, text):
+    """Score how well the query matches a field, both lowercase. Exact and
+    prefix matches score highest, then matches at the start of a word, then
+    other substrings and finally fuzzy subsequence matches, which score
+    higher the closer together the matched characters are."""
+    if len(text) == 0:
+        return 0
+    if text == query:
+        return 100
+    if text.startswith(query):
+        return 80
+    index = text.find(query)
+    if index > 0:
+        if not text[index - 1].isalnum():
+            return 60
+        return 40
+
+    first = -1
+    position = -1
+    for char in query:
+        position = text.find(char, position + 1)
+        if position < 0:
+            return 0
+        if first < 0:
+            first = position
+    gaps = position - first + 1 - len(query)
+    return max(1, 20 - gaps)
+
+
+def get_filename_field(filename):
+    """Return the searchable form of a launcher filename, without the
+    prefixes added by menu editors."""
+    filename = filename.replace("menulibre-", "")
+    filename = filename.replace("alacarte-", "")
+    return filename
+
+
+class SearchIndex:
+    """Trigram index of the searchable launcher and directory fields, keyed
+    by filename. Rows for the same file share a single document.
+
+    The generic name, keywords and MimeType are not stored in the treestore.
+    They are kept in a side table filled from the loaded menu structure with
+    add_details(), so searching them never reads the desktop files.
+
+    search() returns the filenames containing the query as a substring of any
+    field, ignoring case. Queries of three or more characters only check the
+    documents containing all of their trigrams."""
+
+    def __init__(self):
+        self._documents = {}
+        self._details = {}
+        self._features = {}
+        self._trigrams = {}
+        # Incremented whenever a document changes, so earlier results are
+        # known to be out of date.
+        self.generation = 0
+
+    def clear(self):
+        """Remove all documents."""
+        self._documents.clear()
+        self._details.clear()
+        self._features.clear()
+        self._trigrams.clear()
+        self.generation += 1
+
+    def add_details(self, menu_items):
+        """Remember the fields that are read from the menu but not stored in
+        the treestore, from the get_submenus() structure. Rows updated after
+        this are indexed with the new details."""
+        for item_type, entry_id, details, submenus in menu_items:
+            if item_type == MenuItemTypes.SEPARATOR:  # type: ignore
+                continue
+            if details['filename'] is not None:
+                self._details[details['filename']] = {
+                    'generic_name': details['generic_name'] or "",
+                    'keywords': list(details['keywords'] or []),
+                    'mime_types': list(details.get('mime_types') or []),
+                }
+            if submenus is not None:
+                self.add_details(submenus)
+
+    def update(self, filename, name, comment, executable, categories="",
+               launcher=False):
+        """Add or replace the document for filename. Launchers can also be
+        ranked with a RankJob."""
+        details = self._details.get(filename, {})
+        generic_name = details.get('generic_name', "")
+        keywords = details.get('keywords', [])
+        mime_types = details.get('mime_types', [])
+
+        if launcher:
+            self._features[filename] = (
+                (name or "").lower(),
+                generic_name.lower(),
+                [keyword.lower() for keyword in keywords],
+                get_command_name(executable).lower(),
+            )
+        else:
+            self._features.pop(filename, None)
+
+        fields = [name or "", comment or "", executable or "",
+                  get_filename_field(filename), generic_name]
+        fields += keywords
+        fields += [category for category in (categories or "").split(";")
+                   if len(category) > 0]
+        fields += mime_types
+        text = FIELD_SEPARATOR.join(fields).lower()
+
+        previous = self._documents.get(filename)
+        if previous == text:
+            return
+        if previous is not None:
+            self._remove_trigrams(filename, previous)
+
+        self.generation += 1
+        self._documents[filename] = text
+        for trigram in get_trigrams(text):
+            if trigram not in self._trigrams:
+                self._trigrams[trigram] = set()
+            self._trigrams[trigram].add(filename)
+
+    def remove(self, filename):
+        """Remove the document for filename."""
+        self._features.pop(filename, None)
+        previous = self._documents.pop(filename, None)
+        if previous is not None:
+            self.generation += 1
+            self._remove_trigrams(filename, previous)
+
+    def search(self, query, candidates=None):
+        """Return the set of filenames matching the query. If candidates is
+        given, only those filenames are checked."""
+        job = SearchJob(self, query, candidates)
+        while not job.run():
+            pass
+        return job.results
+
+    def get_score(self, filename, query):
+        """Return the relevance of a launcher for the lowercase query, or 0
+        if it does not match."""
+        features = self._features.get(filename)
+        if features is None:
+            return 0
+        name, generic_name, keywords, command = features
+        score = get_field_score(query, name) * FIELD_WEIGHTS[0]
+        score = max(score,
+                    get_field_score(query, generic_name) * FIELD_WEIGHTS[1])
+        for keyword in keywords:
+            score = max(score,
+                        get_field_score(query, keyword) * FIELD_WEIGHTS[2])
+        score = max(score, get_field_score(query, command) * FIELD_WEIGHTS[3])
+        return score
+
+    def get_name(self, filename):
+        """Return the lowercase name of a ranked launcher."""
+        features = self._features.get(filename)
+        if features is None:
+            return ""
+        return features[0]
+
+    def get_launchers(self):
+        """Return the filenames of the launchers that can be ranked."""
+        return list(self._features.keys())
+
+    def get_filenames(self):
+        """Return the set of indexed filenames."""
+        return set(self._documents.keys())
+
+    def get_candidates(self, query):
+        """Return the filenames that may match the lowercase query."""
+        if len(query) < 3:
+            return list(self._documents.keys())
+
+        postings = []
+        for trigram in get_trigrams(query):
+            posting = self._trigrams.get(trigram)
+            if posting is None:
+                return []
+            postings.append(posting)
+        postings.sort(key=len)
+        return list(postings[0].intersection(*postings[1:]))
+
+    def matches(self, filename, query):
+        """Return True if the document for filename contains the lowercase
+        query."""
+        text = self._documents.get(filename)
+        return text is not None and query in text
+
+    def _remove_trigrams(self, filename, text):
+        """Remove filename from the postings of the trigrams in text."""
+        for trigram in get_trigrams(text):
+            posting = self._trigrams.get(trigram)
+            if posting is None:
+                continue
+            posting.discard(filename)
+            if len(posting) == 0:
+                del self._trigrams[trigram]
+
+
+class SearchJob:
+    """A search that can be run a chunk of documents at a time, so that the
+    main loop keeps running while a large menu is searched.
+
+    When the query extends a previous query on the same index generation,
+    pass the previous results as candidates, only those can still match."""
+
+    def __init__(self, index, query, candidates=None):
+        self.index = index
+        self.query = query.lower()
+        self.generation = index.generation
+        self.results = set()
+        if candidates is not None:
+            self._candidates = list(candidates)
+        elif len(self.query) == 0:
+            self._candidates = None
+            self.results = index.get_filenames()
+        else:
+            self._candidates = index.get_candidates(self.query)
+        self._position = 0
+
+    def run(self, limit=None):
+        """Check up to limit more candidates, all of them if limit is None.
+        Return True once the search is complete."""
+        if self._candidates is None:
+            return True
+        end = len(self._candidates)
+        if limit is not None:
+            end = min(end, self._position + limit)
+        for filename in self._candidates[self._position:end]:
+            if self.index.matches(filename, self.query):
+                self.results.add(filename)
+        self._position = end
+        return self._position >= len(self._candidates)
+
+
+class RankJob(SearchJob):
+    """A search ranking the launchers by fuzzy relevance to the query. The
+    results map each matching filename to its score."""
+
+    def __init__(self, index, query, candidates=None):
+        if candidates is None:
+            candidates = index.get_launchers()
+        super().__init__(index, query, candidates)
+        self.results = {}
+
+    def run(self, limit=None):
+        """Score up to limit more candidates, all of them if limit is None.
+        Return True once the search is complete."""
+        end = len(self._candidates)
+        if limit is not None:
+            end = min(end, self._position + limit)
+        for filename in self._candidates[self._position:end]:
+            score = self.index.get_score(filename, self.query)
+            if score > 0:
+                self.results[filename] = score
+        self._position = end
+        return self._position >= len(self._candidates)
+
+    def get_ranked(self):
+        """Return the matching filenames, most relevant first."""
+        return sorted(self.results.keys(),
+                      key=lambda filename: (-self.results[filename],
+                                            self.index.get_name(filename),
+                                            filename))
@@ -0,0 +1,56 @@
+#!/usr/bin/python3
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+#   MenuLibre - Advanced fd.o Compliant Menu Editor
+#   Copyright (C) 2012-2024 Sean Davis <sean@bluesabre.org>
+#
+#   This program is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License version 3, as published
+#   by the Free Software Foundation.
+#
+#   This program is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranties of
+#   MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+#   PURPOSE.  See the GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Generators for walking Gtk.TreeModel rows.
+
+Gtk.TreeStore.iter_nth_child() walks the sibling list from the start, so
+looping over iter_n_children() with it is quadratic in the number of children.
+These walks only step with iter_children(), iter_next() and iter_parent(), and
+visit each row once.
+
+The model must not be changed while a walk is in progress, collect the rows
+in a list first if they are going to be moved or removed.'''
+
+
+def iter_children(model, parent=None):
+    """Yield the treeiter of each child of parent, or of each toplevel row if
+    parent is None."""
+    treeiter = model.iter_children(parent)
+    while treeiter is not None:
+        yield treeiter
+        treeiter = model.iter_next(treeiter)
+
+
+def iter_descendants(model, parent=None):
+    """Yield the treeiter of each row below parent, or of every row if parent
+    is None, in depth-first order (each row before its children)."""
+    stack = [model.iter_children(parent)]
+    while len(stack) > 0:
+        treeiter = stack.pop()
+        if treeiter is None:
+            continue
+        yield treeiter
+        stack.append(model.iter_next(treeiter))
+        stack.append(model.iter_children(treeiter))
+
+
+def iter_ancestors(model, treeiter):
+    """Yield the treeiter of each parent of treeiter, nearest first."""
+    parent = model.iter_parent(treeiter)
+    while parent is not None:
+        yield parent
+        parent = model.iter_parent(parent)
@@ -17,19 +17,29 @@
 #   with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
-import subprocess
+import threading
 
 from locale import gettext as _
 
 from gi.repository import Gio, GObject, Gtk, Pango, GLib  # type: ignore
 
-from . import MenuEditor, MenulibreXdg, XmlMenuElementTree, util
-from .util import MenuItemTypes, check_keypress, getBasename, getRelativeName, escapeText
+from . import MenuCache, MenuEditor, MenulibreMonitor, MenulibreScheduler, MenulibreSearch, MenulibreXdg, XmlMenuElementTree, util
+from menulibre_lib import timed_phase
+from .CategoryEditor import category_lookup
+from .MenulibreTreeWalk import iter_ancestors, iter_children, iter_descendants
+from .util import MenuItemTypes, check_keypress, getBasename, getCollationKey, getRelativeName, escapeText
 
 import logging
 logger = logging.getLogger('menulibre')
 
 
+# Milliseconds to wait for typing to pause before searching.
+SEARCH_DELAY = 150
+
+# Number of launchers checked per main loop iteration while searching.
+SEARCH_CHUNK_SIZE = 500
+
+
 class Treeview(Gtk.Box):
 
     __gsignals__ = {
@@ -41,16 +51,36 @@ class Treeview(Gtk.Box):
         'requires-menu-reload': (GObject.SIGNAL_RUN_LAST,
                                  GObject.TYPE_BOOLEAN,
                                  (GObject.TYPE_BOOLEAN,)),
+        'loaded': (GObject.SIGNAL_RUN_LAST,
+                   GObject.TYPE_BOOLEAN,
+                   (GObject.TYPE_BOOLEAN,)),
     }
 
     loaded = False
+    loading = False
 
     def __init__(self, parent):
         super().__init__(orientation=Gtk.Orientation.VERTICAL, spacing=0)
         self.parent = parent
         self._last_selected_path = -1
         self._search_terms = None
+        self._search_visible = set()
+        self._search_index = MenulibreSearch.SearchIndex()
+        self._search_pending = None
+        self._search_job = None
+        self._search_results = None
+        self._search_ranked = False
+        self._search_list = None
+        self._search_list_refs = []
+        self._search_timeout_id = 0
+        self._search_idle_id = 0
         self._lock_menus = False
+        self._monitor = None
+        self._menu_elements = XmlMenuElementTree.MenuElementCache()
+        self._notifier = MenulibreXdg.MenuUpdateNotifier()
+        # Filename to the TreeRowReferences of its rows, built once the menu
+        # has loaded. Entries may be stale, see _get_filename_rows().
+        self._filename_rows = {}
 
         self.set_size_request(220, -1)
 
@@ -59,12 +89,14 @@ class Treeview(Gtk.Box):
         scrolled.set_name("MenulibreSidebarScroll")
         self.pack_start(scrolled, True, True, 0)
 
-        treestore = MenuEditor.get_treestore()
-        if treestore is not None:
-            self.loaded = True
-            self._treeview = Gtk.TreeView.new_with_model(treestore)
-        else:
-            self._treeview = Gtk.TreeView.new()
+        # The model is filled in by load()
+        self._treestore = MenuEditor.new_treestore()
+        self._treestore.connect("row-inserted", self._on_treestore_row_changed)
+        self._treestore.connect("row-changed", self._on_treestore_row_changed)
+        self._treestore.connect("row-deleted", self._on_treestore_row_edited)
+        self._treestore.connect("rows-reordered",
+                                self._on_treestore_row_edited)
+        self._treeview = Gtk.TreeView.new_with_model(self._treestore)
 
         self._treeview.set_show_expanders(True)
         self._treeview.set_enable_search(False)
@@ -109,7 +141,7 @@ class Treeview(Gtk.Box):
         self._treeview.connect("row-collapsed",
                                self._on_treeview_row_expansion, False)
 
-        self.menu_timeout_id = 0
+        self._menu_writer = MenulibreScheduler.WriteScheduler(self.write_menus)
 
         self._toolbar = Gtk.Toolbar.new()
         self._toolbar.set_icon_size(Gtk.IconSize.MENU)
@@ -136,15 +168,253 @@ class Treeview(Gtk.Box):
 
         img = Gtk.Image.new_from_icon_name(
             'view-sort-ascending-symbolic', Gtk.IconSize.MENU)
-        self._sort_button = Gtk.ToolButton.new(img, _("Sort Alphabetically"))
+        self._sort_button = Gtk.MenuToolButton.new(img,
+                                                   _("Sort Alphabetically"))
         self._sort_button.set_tooltip_text(_("Sort Alphabetically"))
         self._sort_button.connect('clicked', self._sort_iter)
         self._toolbar.add(self._sort_button)
 
+        sort_menu = Gtk.Menu.new()
+        sort_item = Gtk.MenuItem.new_with_label(
+            _("Sort Directory and Subdirectories"))
+        sort_item.connect('activate', self._sort_iter, True)
+        sort_menu.append(sort_item)
+        sort_menu.show_all()
+        self._sort_button.set_menu(sort_menu)
+
         # Show the treeview, grab focus.
         self.show_all()
         self._treeview.grab_focus()
 
+    def load(self):
+        """Load the menu in a worker thread. Toplevel items are added to the
+        model as they are read, and the loaded signal is emitted once the
+        whole menu is available."""
+        if self.loading:
+            return
+        self.loading = True
+        self.loaded = False
+        self._filename_rows = {}
+        self._treestore.clear()
+        self._search_index.clear()
+        self._toolbar.set_sensitive(False)
+        thread = threading.Thread(target=self._load_worker, daemon=True)
+        thread.start()
+
+    def _load_worker(self):
+        """Read the menu, passing each toplevel directory (and any items
+        before it) to the main loop as a batch."""
+        success = False
+        batch = []
+        try:
+            for item in MenuEditor.iter_menus():
+                success = True
+                batch.append(item)
+                if item[0] == MenuItemTypes.DIRECTORY:  # type: ignore
+                    GLib.idle_add(self._load_batch, batch)
+                    batch = []
+        except Exception:  # noqa
+            logger.exception("Failed to load the menu")
+            success = False
+        if len(batch) > 0:
+            GLib.idle_add(self._load_batch, batch)
+        GLib.idle_add(self._load_finished, success)
+
+    def _load_batch(self, items):
+        """Append a batch of toplevel menu items to the model. The rows are
+        added to the search index as they are inserted."""
+        with timed_phase("menu to treestore"):
+            self._search_index.add_details(items)
+            MenuEditor.menu_to_treestore(self._treestore, None, items)
+        return False
+
+    def _load_finished(self, success):
+        """Finish loading the menu and notify the application."""
+        self.loading = False
+        self.loaded = success and self._treestore.get_iter_first() is not None
+        self._toolbar.set_sensitive(True)
+        if self.loaded:
+            self._build_filename_index()
+            self.start_monitoring()
+        self.emit("loaded", self.loaded)
+        return False
+
+# File monitoring
+    def start_monitoring(self):
+        """Watch the launcher and directory files for outside changes."""
+        if self._monitor is None:
+            self._monitor = MenulibreMonitor.MenuMonitor()
+            self._monitor.connect('changed', self._on_menu_files_changed)
+        self._monitor.start()
+
+    def stop_monitoring(self):
+        """Stop watching the launcher and directory files."""
+        if self._monitor is not None:
+            self._monitor.stop()
+
+    def _on_menu_files_changed(self, monitor, basenames):
+        """Apply a batch of launcher and directory changes made outside of
+        menulibre to the affected rows only."""
+        if self.loading:
+            return
+
+        util.invalidatePathCache()
+        MenulibreXdg.desktop_entry_cache.invalidate_relative(basenames)
+        selected_path = self._get_selected_base_path()
+        selected_changed = False
+        for basename in basenames:
+            if self._refresh_file(basename, selected_path):
+                selected_changed = True
+
+        # Show the new contents of the selected launcher, unless it has been
+        # edited since.
+        if selected_changed and not self.parent.get_has_unsaved_changes():
+            self._last_selected_path = -1
+            self._on_treeview_cursor_changed(self._treeview, None)
+
+    def _refresh_file(self, basename, selected_path):
+        """Update, add or remove the rows for a single changed file. Return
+        True if the selected row was updated."""
+        model = self._treestore
+        filename = util.getUserLauncherPath(basename)
+        if filename is None:
+            filename = util.getSystemLauncherPath(basename)
+
+        instances = self._get_relative_name_instances(basename)
+
+        # Deleted with no system file to fall back to. The selected row is
+        # kept, the editor reports it as removed when it is next selected.
+        # Directories are left in place, the menu layout may still list them.
+        if filename is None:
+            if not basename.endswith('.desktop'):
+                return False
+            removed = []
+            for treeiter in reversed(instances):
+                if model.get_path(treeiter) != selected_path:
+                    removed += self._get_subtree_filenames(model, treeiter)
+                    model.remove(treeiter)
+            self._forget_filenames(removed)
+            return False
+
+        item = MenuEditor.get_file_item(filename)
+        if item is None:
+            return False
+        self._search_index.add_details([item])
+        row_data = MenuEditor.get_item_row(item)
+
+        if len(instances) == 0:
+            if item[0] == MenuItemTypes.APPLICATION:  # type: ignore
+                self._insert_by_categories(model, row_data)
+            return False
+
+        selected_changed = False
+        for treeiter in instances:
+            # Keep the expansion state of the existing row.
+            row_data[MenuEditor.COL_EXPAND] = \
+                model[treeiter][MenuEditor.COL_EXPAND]
+            if self._row_data_equal(model[treeiter][:], row_data):  # type: ignore
+                continue
+            self._set_row(treeiter, row_data)
+            if model.get_path(treeiter) == selected_path:
+                selected_changed = True
+        return selected_changed
+
+    def _row_data_equal(self, row_data, other):
+        """Return True if the rows match. Icons are compared by name, the
+        GIcon objects are never equal."""
+        for i in range(len(row_data)):
+            if i == MenuEditor.COL_G_ICON:
+                continue
+            if row_data[i] != other[i]:
+                return False
+        return True
+
+    def _insert_by_categories(self, model, row_data):
+        """Add a new launcher to the top-level directories its categories
+        place it in, sorted by name. Directories are matched by the
+        categories their filename requires, which does not depend on the
+        language of the session. Launchers matching no directory go to the
+        "Other" directory, as GMenu places them."""
+        categories = set([category for category in
+                          row_data[MenuEditor.COL_CATEGORIES].split(';')
+                          if len(category) > 0])
+        directory_names = set()
+        for category in categories:
+            if category in category_lookup.keys():
+                directory_names.add(util.getDirectoryNameFromCategory(
+                    category_lookup[category]))
+
+        parents = []
+        other = None
+        for treeiter in iter_children(model):
+            if model[treeiter][MenuEditor.COL_TYPE] != MenuItemTypes.DIRECTORY:  # type: ignore
+                continue
+            filename = model[treeiter][MenuEditor.COL_FILENAME]
+            required = set()
+            if filename is not None:
+                required = set(util.getRequiredCategories(filename))
+            if len(required & categories) > 0 or \
+                    model[treeiter][MenuEditor.COL_NAME] in directory_names:
+                parents.append(treeiter)
+                continue
+            if other is None and filename is not None:
+                basename = os.path.splitext(os.path.basename(filename))[0]
+                if basename.lower().endswith('other'):
+                    other = treeiter
+
+        if len(parents) == 0:
+            if other is None:
+                logger.debug("No directory found for %s" %
+                             row_data[MenuEditor.COL_FILENAME])
+                return
+            parents = [other]
+
+        name = row_data[MenuEditor.COL_NAME].lower()
+        for parent in parents:
+            sibling = None
+            for treeiter in iter_children(model, parent):
+                sibling_type = model[treeiter][MenuEditor.COL_TYPE]
+                sibling_name = model[treeiter][MenuEditor.COL_NAME]
+                is_application = sibling_type == MenuItemTypes.APPLICATION  # type: ignore
+                if is_application and sibling_name.lower() > name:
+                    sibling = treeiter
+                    break
+            model.insert_before(parent, sibling, row_data)
+
+    def _get_relative_name_instances(self, basename):
+        """Return a list of all treestore iters for launchers or directories
+        with the relative name, in any of the search paths. The rows are
+        looked up in the filename index."""
+        if basename.endswith('.desktop'):
+            paths = [util.getUserApplicationsDirectory()]
+            paths += util.getItemSearchPaths()
+        else:
+            paths = [util.getUserDirectoriesDirectory()]
+            paths += util.getDirectorySearchPaths()
+
+        treeiters = []
+        filenames = set()
+        for path in paths:
+            filename = os.path.realpath(os.path.join(path, basename))
+            if filename in filenames:
+                continue
+            filenames.add(filename)
+            treeiters += self._get_filename_rows(filename)
+        model = self._treestore
+        treeiters.sort(key=lambda treeiter:
+                       model.get_path(treeiter).get_indices())
+        return treeiters
+
+    def _get_selected_base_path(self):
+        """Return the path of the selected row in the unfiltered model."""
+        model, treeiter = self._get_selected_iter()
+        if treeiter is None:
+            return None
+        if isinstance(model, Gtk.TreeModelFilter):
+            treeiter = model.convert_iter_to_child_iter(treeiter)
+            model = model.get_model()
+        return model.get_path(treeiter)
+
     def set_sortable(self, sortable):
         self._sort_button.set_sensitive(sortable)
 
@@ -225,18 +495,20 @@ class Treeview(Gtk.Box):
             del_files = del_dirs + del_apps
 
             # Uninstall the launcher
-            self.xdg_menu_uninstall(model, treeiter, filename)
+            if self.xdg_menu_uninstall(model, treeiter, filename):
+                self.xdg_menu_update()
 
             # Delete each of the files - this will fail silently for non-user
             # desktop files/directories, these are hidden below
             for filename in del_files:
                 try:
                     os.remove(filename)
+                    self.xdg_menu_update()
                 except:  # noqa
                     pass
 
-        self.xdg_menu_update()
-        self._cleanup_applications_merged()
+        if self._cleanup_applications_merged():
+            self.xdg_menu_update()
 
         if not ui_only:
 
@@ -256,13 +528,14 @@ class Treeview(Gtk.Box):
                 # Original found (this is a system-installed desktop file/
                 # directory rather than a user-made one), hide the desktop file
                 # and all associated instances in the menu
-                entry = MenulibreXdg.MenulibreDesktopEntry(original)
+                entry = MenulibreXdg.get_desktop_entry(original)
                 name = entry['Name']
                 comment = entry['Comment']
                 categories = entry['Categories']
                 executable = entry['Exec']
                 icon_name = entry['Icon']
-                hidden = entry['Hidden'] or entry['NoDisplay']
+                hidden = entry.get_boolean("Desktop Entry", "Hidden") or \
+                    entry.get_boolean("Desktop Entry", "NoDisplay")
                 self.update_selected(
                     name,
                     comment,
@@ -276,11 +549,15 @@ class Treeview(Gtk.Box):
                 self.update_launcher_instances(filename, row_data)
                 treeiter = None
 
+        if treeiter is not None and model is not self._treeview.get_model():
+            # Listed search results, keep the result row like the filter.
+            model, treeiter = self._treeview.get_selection().get_selected()
+
         if treeiter is not None:
             path = model.get_path(treeiter)
             if model is not None and treeiter is not None:
-                if not isinstance(model, Gtk.TreeModelFilter):
-                    model.remove(treeiter)
+                if model is self._treestore:
+                    self.remove_iter(model, treeiter)
             if path:
                 self._treeview.set_cursor(path)
 
@@ -293,7 +570,25 @@ class Treeview(Gtk.Box):
 
         # This feels a bit redundant for a function, but it keeps the
         # functionality close to remove_selected
+        filenames = self._get_subtree_filenames(model, treeiter)
         model.remove(treeiter)
+        self._forget_filenames(filenames)
+
+    def _get_subtree_filenames(self, model, treeiter):
+        """Return the filenames of the row and the rows below it."""
+        filenames = [model[treeiter][MenuEditor.COL_FILENAME]]
+        for child_iter in iter_descendants(model, treeiter):
+            filenames.append(model[child_iter][MenuEditor.COL_FILENAME])
+        return filenames
+
+    def _forget_filenames(self, filenames):
+        """Remove the files that no longer have any rows from the search
+        index, so removed and renamed launchers stop matching."""
+        for filename in set(filenames):
+            if filename is None:
+                continue
+            if len(self._get_filename_rows(filename)) == 0:
+                self._search_index.remove(filename)
 
 # Get
     def get_parent(self, model=None, treeiter=None):
@@ -381,12 +676,26 @@ class Treeview(Gtk.Box):
                                       can_select_func)
 
 # Update
+    def update_search_details(self, filename):
+        """Read the search fields that are not shown in the treeview, such as
+        the keywords, from a saved launcher or directory file. Call before
+        updating its rows."""
+        item = MenuEditor.get_file_item(filename)
+        if item is not None:
+            self._search_index.add_details([item])
+
     def update_launcher_instances(self, filename, row_data):
         """Update all same launchers with the new information."""
-        model, treeiter = self._get_selected_iter()
-        for instance in self._get_launcher_instances(filename, model):
-            for i in range(len(row_data)):
-                model[instance][i] = row_data[i]
+        for instance in self._get_filename_rows(filename):
+            self._set_row(instance, row_data)
+        if row_data[MenuEditor.COL_FILENAME] != filename:
+            self._forget_filenames([filename])
+
+    def _set_row(self, treeiter, row_data):
+        """Replace all of the columns of a treestore row, emitting a single
+        row-changed signal."""
+        self._treestore.set(treeiter, list(range(len(row_data))),
+                            list(row_data))
 
     def update_selected(self, name, comment, executable, categories, item_type,
                         icon_name, filename, show=True):
@@ -395,21 +704,27 @@ class Treeview(Gtk.Box):
         if treeiter is None:
             return
 
-        model[treeiter][MenuEditor.COL_NAME] = name
-        model[treeiter][MenuEditor.COL_DISPLAY_NAME] = escapeText(name)
-        model[treeiter][MenuEditor.COL_COMMENT] = comment
-        model[treeiter][MenuEditor.COL_EXEC] = executable
-        model[treeiter][MenuEditor.COL_CATEGORIES] = categories
-        model[treeiter][MenuEditor.COL_TYPE] = item_type
+        if isinstance(model, Gtk.TreeModelFilter):
+            treeiter = model.convert_iter_to_child_iter(treeiter)
+            model = model.get_model()
+
+        row_data = model[treeiter][:]
+        row_data[MenuEditor.COL_NAME] = name
+        row_data[MenuEditor.COL_DISPLAY_NAME] = escapeText(name)
+        row_data[MenuEditor.COL_COMMENT] = comment
+        row_data[MenuEditor.COL_EXEC] = executable
+        row_data[MenuEditor.COL_CATEGORIES] = categories
+        row_data[MenuEditor.COL_TYPE] = item_type
         if os.path.isfile(icon_name):
             gfile = Gio.File.parse_name(icon_name)
             icon = Gio.FileIcon.new(gfile)
         else:
             icon = Gio.ThemedIcon.new(icon_name)
-        model[treeiter][MenuEditor.COL_G_ICON] = icon
-        model[treeiter][MenuEditor.COL_ICON_NAME] = icon_name
-        model[treeiter][MenuEditor.COL_FILENAME] = filename
-        model[treeiter][MenuEditor.COL_SHOW] = show
+        row_data[MenuEditor.COL_G_ICON] = icon
+        row_data[MenuEditor.COL_ICON_NAME] = icon_name
+        row_data[MenuEditor.COL_FILENAME] = filename
+        row_data[MenuEditor.COL_SHOW] = show
+        self._set_row(treeiter, row_data)
 
         # Refresh the displayed launcher
         self._last_selected_path = -1
@@ -504,9 +819,17 @@ class Treeview(Gtk.Box):
         renderer.set_property("sensitive", not separator)
 
     def _get_selected_iter(self):
-        """Return the current treeview model and selected iter."""
+        """Return the current treeview model and selected iter. While search
+        results are listed, the menu tree row of the result is returned."""
         model: Gtk.TreeStore
         model, treeiter = self._treeview.get_selection().get_selected()  # type: ignore
+        if treeiter is not None and model is self._search_list:
+            index = model.get_path(treeiter).get_indices()[0]
+            reference = self._search_list_refs[index]
+            if not reference.valid():
+                return self._treestore, None
+            return self._treestore, self._treestore.get_iter(
+                reference.get_path())
         return model, treeiter
 
     def _populate_and_select_iter(self, model, treeiter, row_data,
@@ -544,8 +867,7 @@ class Treeview(Gtk.Box):
                 block_run = True
 
         if model.iter_has_child(treeiter) and not block_run:
-            for i in range(model.iter_n_children(treeiter)):
-                child_iter = model.iter_nth_child(treeiter, i)
+            for child_iter in iter_children(model, treeiter):
                 filename = model[child_iter][MenuEditor.COL_FILENAME]
                 if filename is not None:
                     if filename.endswith('.directory'):
@@ -573,31 +895,75 @@ class Treeview(Gtk.Box):
         row = model[treeiter]
         return treeview.row_expanded(row.path)
 
-    def _get_launcher_instances(self, filename, model=None, parent=None):
-        """Return a list of all treeiters referencing this filename."""
+    def _get_launcher_instances(self, filename, model=None):
+        """Return a list of all treeiters referencing this filename, in tree
+        order. The treeiters belong to model, by default the model of the
+        current selection."""
         if filename is None:
             return []
         if model is None:
             model, treeiter = self._get_selected_iter()
+        treeiters = self._get_filename_rows(filename)
+        if model is self._treestore:
+            return treeiters
+        if isinstance(model, Gtk.TreeModelFilter):
+            # Only the rows shown by the filter.
+            filtered = []
+            for treeiter in treeiters:
+                found, f_iter = model.convert_child_iter_to_iter(treeiter)
+                if found:
+                    filtered.append(f_iter)
+            return filtered
+        return []
+
+    def _get_filename_rows(self, filename):
+        """Return the treestore iters of the rows for filename, in tree order.
+        References to removed rows, or to rows that now have a different
+        filename, are dropped here."""
+        model = self._treestore
+        references = []
         treeiters = []
-        for n_child in range(model.iter_n_children(parent)):
-            treeiter = model.iter_nth_child(parent, n_child)
-            if treeiter is None:
+        for reference in self._filename_rows.get(filename, []):
+            if not reference.valid():
                 continue
-            iter_filename = model[treeiter][MenuEditor.COL_FILENAME]
-            if iter_filename == filename:
-                treeiters.append(treeiter)
-            if model.iter_has_child(treeiter):
-                treeiters += self._get_launcher_instances(filename, model,
-                                                          treeiter)
+            treeiter = model.get_iter(reference.get_path())
+            if model[treeiter][MenuEditor.COL_FILENAME] != filename:
+                continue
+            references.append(reference)
+            treeiters.append(treeiter)
+
+        if len(references) > 0:
+            self._filename_rows[filename] = references
+        else:
+            self._filename_rows.pop(filename, None)
+
+        treeiters.sort(key=lambda treeiter:
+                       model.get_path(treeiter).get_indices())
         return treeiters
 
+    def _add_filename_row(self, model, path, filename):
+        """Add a row to the filename index, unless it is already listed."""
+        references = self._filename_rows.setdefault(filename, [])
+        for reference in references:
+            if reference.valid() and reference.get_path() == path:
+                return
+        references.append(Gtk.TreeRowReference.new(model, path))
+
+    def _build_filename_index(self, parent=None):
+        """Add the rows below parent, or all rows, to the filename index."""
+        model = self._treestore
+        for treeiter in iter_descendants(model, parent):
+            filename = model[treeiter][MenuEditor.COL_FILENAME]
+            if filename is not None:
+                self._add_filename_row(model, model.get_path(treeiter),
+                                       filename)
+
     def _get_n_launcher_instances(self, filename):
         return len(self._get_launcher_instances(filename))
 
     def _is_menu_locked(self):
         """Return True if menu editing is currently locked."""
-        return self._lock_menus
+        return self._lock_menus or self.loading
 
     def _update_add_directory(self):
         """Prevent adding subdirectories to system menus."""
@@ -616,13 +982,139 @@ class Treeview(Gtk.Box):
 
 # Search
     def search(self, terms):
-        """Search the treeview for the specified terms."""
-        self._search_terms = str(terms.lower())
-        model: Gtk.TreeModelFilter = self._treeview.get_model()  # type: ignore
+        """Search the treeview for the specified terms. The search starts once
+        typing has paused for SEARCH_DELAY milliseconds and runs in chunks,
+        a newer query cancels the one in progress."""
+        self._search_pending = str(terms.lower())
+        self._cancel_search()
+        self._search_timeout_id = GLib.timeout_add(SEARCH_DELAY,
+                                                   self._on_search_timeout)
+
+    def _cancel_search(self):
+        """Stop any scheduled or running search."""
+        if self._search_timeout_id > 0:
+            GLib.source_remove(self._search_timeout_id)
+            self._search_timeout_id = 0
+        if self._search_idle_id > 0:
+            GLib.source_remove(self._search_idle_id)
+            self._search_idle_id = 0
+        self._search_job = None
+
+    def _on_search_timeout(self):
+        """Start searching for the pending query."""
+        self._search_timeout_id = 0
+        query = self._search_pending
+
+        # Results for a shorter query are a superset of the results for a
+        # query extending it, unless the index has changed since.
+        candidates = None
+        previous = self._search_results
+        if previous is not None:
+            previous_query, generation, matches = previous
+            if query.startswith(previous_query) and \
+                    generation == self._search_index.generation:
+                candidates = matches
+
+        if self._search_ranked:
+            job_type = MenulibreSearch.RankJob
+        else:
+            job_type = MenulibreSearch.SearchJob
+        self._search_job = job_type(self._search_index, query, candidates)
+        self._search_idle_id = GLib.idle_add(self._on_search_idle)
+        return False
+
+    def _on_search_idle(self):
+        """Search the next chunk, show the results once complete."""
+        job = self._search_job
+        if job is None:
+            self._search_idle_id = 0
+            return False
+        if not job.run(SEARCH_CHUNK_SIZE):
+            return True
+        self._search_idle_id = 0
+        self._search_job = None
+        self._search_results = (job.query, job.generation, job.results)
+        if self._search_ranked:
+            self._show_ranked_results(job.get_ranked())
+        else:
+            self._show_search_results(job.query, job.results)
+        return False
+
+    def _show_search_results(self, query, matches):
+        """Filter the treeview to the matching rows."""
+        model = self._treeview.get_model()
+        if not isinstance(model, Gtk.TreeModelFilter):
+            return
+        self._search_terms = query
+        self._search_visible = self._get_search_visible(matches)
         model.refilter()
 
+        # Every visible row with children is an ancestor of a match, so
+        # expanding the filtered tree once shows all of the results.
+        self._treeview.expand_all()
+
+    def _show_ranked_results(self, filenames):
+        """List the matching launchers, most relevant first."""
+        model = self._search_list
+        if model is None or self._treeview.get_model() is not model:
+            return
+
+        selected = self.get_selected_filename()
+
+        model.clear()
+        self._search_list_refs = []
+        selected_path = None
+        for filename in filenames:
+            # The first row for the launcher, in tree order.
+            rows = self._get_filename_rows(filename)
+            if len(rows) == 0:
+                continue
+            treeiter = rows[0]
+            path = self._treestore.get_path(treeiter)
+            list_iter = model.append(self._treestore[treeiter][:])
+            self._search_list_refs.append(
+                Gtk.TreeRowReference.new(self._treestore, path))
+            if filename == selected and selected_path is None:
+                selected_path = model.get_path(list_iter)
+
+        # Keep the selected launcher selected, without reloading the editor.
+        if selected_path is not None:
+            self._last_selected_path = str(selected_path)
+            self._treeview.set_cursor(selected_path)
+
+    def set_search_ranked(self, ranked):
+        """Show search results as a flat list ranked by relevance instead of
+        filtering the menu tree."""
+        if ranked == self._search_ranked:
+            return
+        self._search_ranked = ranked
+        self._search_results = None
+
+        # Switch the view of the current search, if any.
+        model = self._treeview.get_model()
+        if model is None or model is self._treestore:
+            return
+        self._cancel_search()
+        self._search_terms = ""
+        self._search_visible = set()
+        self._treeview.set_model(self._new_search_model())
+        if self._search_pending:
+            self.search(self._search_pending)
+
+    def _new_search_model(self):
+        """Return the model used to show search results."""
+        self._search_list = None
+        self._search_list_refs = []
+        if self._search_ranked:
+            self._search_list = MenuEditor.new_liststore()
+            return self._search_list
+        model = self._treestore.filter_new()
+        model.set_visible_func(self._treeview_match_func)
+        return model
+
     def set_searchable(self, searchable, expand=False):
-        """Set the TreeView searchable."""
+        """Set the TreeView searchable. The results are expanded by search(),
+        expand is kept for compatibility."""
         model = self._treeview.get_model()
         if model is None:
             return
@@ -633,36 +1125,34 @@ class Treeview(Gtk.Box):
             self._treeview.set_headers_visible(True)
             self._toolbar.set_sensitive(False)
 
-            # If specified, expand the treeview.
-            if expand:
-                self._treeview.expand_all()
-
-            # If the model is not a filter, make it so.
-            if not isinstance(model, Gtk.TreeModelFilter):
-                model = model.filter_new()
-                self._treeview.set_model(model)
-                model.set_visible_func(self._treeview_match_func)
+            # Switch to the search results model. With the filtered tree, all
+            # rows are shown until the first results are ready.
+            if model is self._treestore:
+                self._search_terms = ""
+                self._search_visible = set()
+                self._treeview.set_model(self._new_search_model())
 
         else:
+            self._cancel_search()
+            self._search_results = None
             self._lock_menus = False
             # Hide the headers and enable the inline toolbar.
             self._treeview.set_headers_visible(False)
             self._toolbar.set_sensitive(True)
 
-            if isinstance(model, Gtk.TreeModelFilter):
+            if model is not self._treestore:
                 # Get the model and iter.
                 f_model, f_iter = self._get_selected_iter()
 
                 # Restore the original model.
-                model = model.get_model()
+                model = self._treestore
+                self._search_list = None
+                self._search_list_refs = []
                 self._treeview.set_model(model)
 
                 # Restore expanded items (lp 1307000)
                 self._treeview.collapse_all()
-                for n_child in range(model.iter_n_children(None)):
-                    treeiter = model.iter_nth_child(None, n_child)
-                    if treeiter is None:
-                        continue
+                for treeiter in iter_children(model):
                     row = model[treeiter]
                     if row[MenuEditor.COL_FILENAME]:
                         self._treeview.expand_row(row.path, False)
@@ -682,61 +1172,27 @@ class Treeview(Gtk.Box):
                     path = model.get_path(selected_iter)
                     self._treeview.set_cursor(path)
 
-    def _treeview_match(self, model, treeiter, query):
-        """Match subfunction for filtering search results."""
-        name = model[treeiter][MenuEditor.COL_NAME]
-        comment = model[treeiter][MenuEditor.COL_COMMENT]
-        executable = model[treeiter][MenuEditor.COL_EXEC]
-        item_type = model[treeiter][MenuEditor.COL_TYPE]
-        desktop = model[treeiter][MenuEditor.COL_FILENAME]
-
-        # Hide separators in the search results.
-        if item_type == MenuItemTypes.SEPARATOR:  # type: ignore
-            return False
-
-        # Convert None to blank.
-        if not name:
-            name = ""
-        if not comment:
-            comment = ""
-        if not executable:
-            executable = ""
-
-        # Expand all the rows.
-        self._treeview.expand_all()
-
-        # Match against the name.
-        if query in name.lower():
-            return True
-
-        # Match against the comment.
-        if query in comment.lower():
-            return True
-
-        if query in executable.lower():
-            return True
-
-        # Match against the desktop file.
-        desktop = desktop.replace("menulibre-", "")
-        desktop = desktop.replace("alacarte-", "")
-        if query in desktop.lower():
-            return True
-
-        # Show the directory if any child items match.
-        if item_type == MenuItemTypes.DIRECTORY:  # type: ignore
-            return self._treeview_match_directory(query, model, treeiter)
-
-        # No matches, return False.
-        return False
-
-    def _treeview_match_directory(self, query, model, treeiter):
-        """Match subfunction for matching directory children."""
-        for child_i in range(model.iter_n_children(treeiter)):
-            child = model.iter_nth_child(treeiter, child_i)
-            if self._treeview_match(model, child, query):
-                return True
-
-        return False
+    def _get_search_visible(self, matches):
+        """Return the paths (as strings) of the rows to show for the matching
+        filenames: the matching rows and the directories containing them.
+        The rows are found in the filename index and only their ancestors
+        are walked, so rows without a filename, such as separators, are
+        never shown."""
+        model = self._treestore
+        visible = set()
+        for filename in matches:
+            for treeiter in self._get_filename_rows(filename):
+                path = model.get_path(treeiter).to_string()
+                if path in visible:
+                    continue
+                visible.add(path)
+                for parent in iter_ancestors(model, treeiter):
+                    path = model.get_path(parent).to_string()
+                    # The rest of the ancestors were added with it.
+                    if path in visible:
+                        break
+                    visible.add(path)
+        return visible
 
     def _treeview_match_func(self, model, treeiter, data=None):
         """Match function for filtering search results."""
@@ -744,7 +1200,53 @@ class Treeview(Gtk.Box):
         if self._search_terms == "":
             return True
 
-        return self._treeview_match(model, treeiter, self._search_terms)
+        return model.get_path(treeiter).to_string() in self._search_visible
+
+    def _on_treestore_row_changed(self, model, path, treeiter):
+        """Keep the listed search results, the filename index, the search
+        index and the cached menu XML up to date with inserted and changed
+        rows. Removed and moved rows are tracked by their TreeRowReferences
+        in the filename index."""
+        row_data = model[treeiter][:]
+        if self._search_list is not None:
+            for i, reference in enumerate(self._search_list_refs):
+                if reference.valid() and reference.get_path() == path:
+                    self._search_list[i] = row_data
+
+        self._on_treestore_row_edited(model, path, treeiter)
+
+        filename = row_data[MenuEditor.COL_FILENAME]
+        if filename is None:
+            return
+        if not self.loading:
+            self._add_filename_row(model, path, filename)
+        item_type = row_data[MenuEditor.COL_TYPE]
+        launcher = item_type in [MenuItemTypes.APPLICATION,  # type: ignore
+                                 MenuItemTypes.LINK]  # type: ignore
+        self._search_index.update(filename,
+                                  row_data[MenuEditor.COL_NAME],
+                                  row_data[MenuEditor.COL_COMMENT],
+                                  row_data[MenuEditor.COL_EXEC],
+                                  row_data[MenuEditor.COL_CATEGORIES],
+                                  launcher)
+
+    def _on_treestore_row_edited(self, model, path, treeiter=None,
+                                 new_order=None):
+        """Rebuild the menu XML of the directories containing the inserted,
+        changed, deleted or reordered rows on the next write."""
+        path = path.copy()
+        if new_order is not None:
+            # Reordered, path is the directory that was sorted.
+            path.down()
+        elif treeiter is not None and model[treeiter][MenuEditor.COL_TYPE] \
+                == MenuItemTypes.DIRECTORY:  # type: ignore
+            # A changed directory row may have a new filename.
+            self._menu_elements.invalidate(
+                model[treeiter][MenuEditor.COL_FILENAME])
+        while path.up() and path.get_depth() > 0:
+            treeiter = model.get_iter(path)
+            self._menu_elements.invalidate(
+                model[treeiter][MenuEditor.COL_FILENAME])
 
 # XDG Menu Commands
     def xdg_menu_install(self, filename, parent=None):
@@ -756,15 +1258,12 @@ class Treeview(Gtk.Box):
             return
         if filename.endswith('.desktop'):
             menu_install = True
-            parents = []
             if parent is None:
-                parent = model.iter_parent(treeiter)
-            while parent is not None:
-                parent_filename = model[parent][MenuEditor.COL_FILENAME]
-
-                # Do not do this method if this is a known system directory.
-                parents.append(parent_filename)
-                parent = model.iter_parent(parent)
+                ancestors = list(iter_ancestors(model, treeiter))
+            else:
+                ancestors = [parent] + list(iter_ancestors(model, parent))
+            parents = [model[ancestor][MenuEditor.COL_FILENAME]
+                       for ancestor in ancestors]
             parents.reverse()
             if menu_install:
                 installed = MenulibreXdg.desktop_menu_install(parents, [
@@ -773,52 +1272,70 @@ class Treeview(Gtk.Box):
                     self.emit("requires-menu-reload", True)
 
     def xdg_menu_uninstall(self, model, treeiter, filename):
-        """Uninstall the specified filename from the menu structure."""
+        """Uninstall the specified filename from the menu structure. Return
+        True if the menu files were changed."""
         if filename is None:
-            return
+            return False
         if filename.endswith('.desktop'):
             menu_install = True
             menu_prefix = util.getDefaultMenuPrefix()
             parents = []
-            parent = model.iter_parent(treeiter)
-            while parent is not None:
+            for parent in iter_ancestors(model, treeiter):
                 parent_filename = model[parent][MenuEditor.COL_FILENAME]
                 # Do not do this method if this is a known system directory.
                 if getBasename(parent_filename).startswith(menu_prefix):
                     menu_install = False
                 parents.append(parent_filename)
-                parent = model.iter_parent(parent)
             parents.reverse()
             if menu_install:
-                MenulibreXdg.desktop_menu_uninstall(parents, [filename])
+                return MenulibreXdg.desktop_menu_uninstall(parents, [filename])
+        return False
 
     def xdg_menu_update(self):
-        """Force an update of the Xdg Menu."""
-        MenulibreXdg.desktop_menu_update()
+        """Update the Xdg Menu with the next menu write, after launcher,
+        directory or merged menu files were created or removed."""
+        self._notifier.add_file_change()
 
     def update_menus(self):
-        """Update the menu files."""
-        if self.menu_timeout_id > 0:
-            GLib.source_remove(self.menu_timeout_id)
-        self.menu_timeout_id = GLib.timeout_add_seconds(
-            1, self.update_menu_timeout)
+        """Update the menu files, once the changes stop for a moment."""
+        self._menu_writer.schedule()
 
-    def update_menu_timeout(self):
+    def flush_menus(self):
+        """Write any pending menu changes now."""
+        self._menu_writer.flush()
+
+    def set_menu_write_delay(self, delay, max_latency=None):
+        """Set how long to wait for more changes before writing the menu
+        files, and how long a change may wait at most, in milliseconds."""
+        self._menu_writer.set_delay(delay, max_latency)
+
+    def write_menus(self):
+        """Write the menu files."""
         # Do not save menu layout if in search mode (lp #1306999)
         if not self._is_menu_locked():
-            XmlMenuElementTree.treeview_to_xml(self._treeview)
-            self.update_menus_kde()
-        self.menu_timeout_id = 0
-        return False
-
-    def update_menus_kde(self):
-        try:
-            subprocess.Popen(["kbuildsycoca5"])
-        except FileNotFoundError:
-            pass
+            if XmlMenuElementTree.treeview_to_xml(self._treeview,
+                                                  self._menu_elements):
+                self._notifier.add_menu_change()
+        # The cached menu structure no longer matches the files on disk.
+        if self._notifier.get_pending():
+            MenuCache.invalidate()
+        # Let the desktop environment know, once for all the changes.
+        self._notifier.notify()
+
+    def notify_files_changed(self, created=True):
+        """Update the desktop menu after a launcher was written outside of
+        the menu structure. Only a new file needs xdg-desktop-menu, an
+        existing file that was rewritten counts as a menu change."""
+        if created:
+            self.xdg_menu_update()
+        else:
+            self._notifier.add_menu_change()
+        self.update_menus()
 
     def _cleanup_applications_merged(self):
-        """Cleanup items from ~/.config/menus/applications-merged"""
+        """Cleanup items from ~/.config/menus/applications-merged. Return
+        True if any were removed."""
+        removed = False
         # xdg-desktop-menu installs menu files in
         # ~/.config/menus/applications-merged, but does not remove them
         # correctly.
@@ -859,6 +1376,8 @@ class Treeview(Gtk.Box):
                     if remove_file:
                         logger.debug("Removing useless %s" % menufile)
                         os.remove(menufile)
+                        removed = True
+        return removed
 
 # TreeView iter tricks
     def _move_iter(self, widget, user_data):  # noqa
@@ -970,16 +1489,9 @@ class Treeview(Gtk.Box):
         """Search the TreeModel for a row matching row_data.
 
         Return the TreeIter found or None if none found."""
-        for n_child in range(model.iter_n_children(parent)):
-            treeiter = model.iter_nth_child(parent, n_child)
-            if treeiter is None:
-                continue
+        for treeiter in iter_descendants(model, parent):
             if model[treeiter][:] == row_data:  # type: ignore
                 return treeiter
-            if model.iter_n_children(treeiter) != 0:
-                value = self._get_iter_by_data(row_data, model, treeiter)
-                if value is not None:
-                    return value
         return None
 
     def _move_iter_up_level(self, treeview, treeiter, relative_position):
@@ -1035,57 +1547,53 @@ class Treeview(Gtk.Box):
         treeview.set_cursor(path)
         return new_iter
 
-    def _sort_iter(self, widget):
-        """Alphabetical sort of items in the current directory."""
+    def _sort_iter(self, widget, recursive=False):
+        """Alphabetical sort of items in the current directory, and of the
+        directories below it if recursive is True."""
 
         # Get the current selected row
         model, sel_iter = self._get_selected_iter()
-        if sel_iter is not None:
-
-            # Move to the parent iter - if there is no parent, it must be the
-            # top level, which is ignored
-            item_names = []
-            _, parent_iter = self.get_parent(model, sel_iter)
-            if parent_iter:
-
-                # Deteriming list of item names
-                for i in range(model.iter_n_children(parent_iter)):
-                    child_iter = model.iter_nth_child(parent_iter, i)
-                    if child_iter is not None:
-                        item_names.append(model[child_iter][MenuEditor.COL_NAME])
-
-                # Applying unstable (?) case-insensitive alphabetical sort
-                item_names = sorted(item_names, key=str.lower)
-
-                for i in range(len(item_names)):
-                    child_iter = model.iter_nth_child(parent_iter, i)
-                    if child_iter is None:
-                        continue
-
-                    # Ignore if item is already sorted or at least has an
-                    # identical title to that expected
-                    if item_names[i] != model[child_iter][MenuEditor.COL_NAME]:
-                        search_iter = None
-
-                        # Locating desired item in the remaining unsorted items
-                        for r in range(i, len(item_names)):
-                            search_iter = model.iter_nth_child(parent_iter, r)
-                            if search_iter is None:
-                                continue
-                            if item_names[i] == model[search_iter][MenuEditor.COL_NAME]:
-                                break
-
-                        if search_iter is not None:
-                            # Moving the found item into place
-                            model.move_before(search_iter, child_iter)
-
-                # Committing changes
-                self.update_menus()
-
-            self.scroll_to_selection()
+        if sel_iter is None:
+            return
+
+        # Move to the parent iter - if there is no parent, it must be the
+        # top level, which is ignored
+        _, parent_iter = self.get_parent(model, sel_iter)
+        if parent_iter is None:
+            return
+
+        directories = [parent_iter]
+        if recursive:
+            directories += [treeiter for treeiter in
+                            iter_descendants(model, parent_iter)
+                            if model.iter_has_child(treeiter)]
+
+        changed = False
+        for directory in directories:
+            if self._sort_children(model, directory):
+                changed = True
+
+        # Committing changes
+        if changed:
+            self.update_menus()
+
+        self.scroll_to_selection()
+
+    def _sort_children(self, model, parent):
+        """Sort the children of parent by name with a single reorder. The sort
+        is stable, so items with the same name keep their order. Return True
+        if the order changed."""
+        names = [model[treeiter][MenuEditor.COL_NAME] or ""
+                 for treeiter in iter_children(model, parent)]
+        new_order = sorted(range(len(names)),
+                           key=lambda index: getCollationKey(names[index]))
+        if new_order == list(range(len(names))):
+            return False
+        model.reorder(parent, new_order)
+        return True
 
     def scroll_to_selection(self):
-        model, sel_iter = self._get_selected_iter()
+        model, sel_iter = self._treeview.get_selection().get_selected()
         if sel_iter is None:
             return
         self._treeview.scroll_to_cell(model.get_path(sel_iter), None,
@@ -0,0 +1,172 @@
+#!/usr/bin/python3
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+#   MenuLibre - Advanced fd.o Compliant Menu Editor
+#   Copyright (C) 2012-2024 Sean Davis <sean@bluesabre.org>
+#
+#   This program is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License version 3, as published
+#   by the Free Software Foundation.
+#
+#   This program is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranties of
+#   MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+#   PURPOSE.  See the GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import concurrent.futures
+import logging
+import os
+import time
+
+from . import util
+from .util import ValidationErrors
+
+from menulibre_lib import record_phase
+
+logger = logging.getLogger('menulibre')
+
+
+# A desktop file that GMenu will fail to load, with the ValidationErrors code
+# and a translated message describing the problem.
+ValidationResult = collections.namedtuple(
+    'ValidationResult', ['filename', 'code', 'message'])
+
+
+def get_desktop_files():
+    """Return the .desktop files GMenu will read, in search path order. Files
+    hidden by a higher priority file with the same desktop file id are
+    skipped, as GMenu never loads them."""
+    search_paths = [util.getUserApplicationsDirectory()]
+    search_paths += util.getItemSearchPaths()
+
+    file_ids = set()
+    desktop_files = []
+    for path in search_paths:
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if not filename.endswith('.desktop'):
+                    continue
+                filename = os.path.join(dirpath, filename)
+
+                # Desktop files in subdirectories get a prefix, e.g.
+                # kde4/kate.desktop has the desktop file id kde4-kate.desktop
+                file_id = os.path.relpath(filename, path).replace('/', '-')
+                if file_id in file_ids:
+                    continue
+                file_ids.add(file_id)
+                desktop_files.append(filename)
+    return desktop_files
+
+
+def validate(filename):
+    """Return a ValidationResult for the desktop file, or None if GMenu will
+    load it (or intentionally skip it)."""
+    code, message = util.get_desktop_file_error(filename)
+    if code in [ValidationErrors.NONE,  # type: ignore
+                ValidationErrors.SKIPPED]:  # type: ignore
+        return None
+    return ValidationResult(filename, code, message)
+
+
+class ValidationStats:
+    """Throughput figures for a validation run."""
+
+    def __init__(self):
+        self.files = 0
+        self.invalid = 0
+        self.jobs = 1
+        self.elapsed = 0.0
+
+    def get_files_per_second(self):
+        """Return the number of files validated per second."""
+        if self.elapsed <= 0:
+            return 0.0
+        return self.files / self.elapsed
+
+    def __str__(self):
+        return "%i files, %i invalid, %.3f s, %.1f files/s (%i jobs)" % (
+            self.files, self.invalid, self.elapsed,
+            self.get_files_per_second(), self.jobs)
+
+
+def get_default_jobs():
+    """Return the default number of validation workers, one per CPU."""
+    return os.cpu_count() or 1
+
+
+def iter_validate(filenames, jobs, cancellable=None):
+    """Yield the validate() result for each filename, in order, using a pool
+    of worker threads. GLib releases the GIL while parsing, so the keyfile
+    loading and PATH lookups run in parallel."""
+    if jobs <= 1:
+        for filename in filenames:
+            if cancellable is not None and cancellable.is_cancelled():
+                return
+            yield validate(filename)
+        return
+
+    # Keep a bounded window of pending files so that results are streamed
+    # back in order and cancellation does not wait on the whole list.
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    pending = collections.deque()
+    filenames = iter(filenames)
+    try:
+        for filename in filenames:
+            pending.append(executor.submit(validate, filename))
+            if len(pending) >= jobs * 4:
+                break
+        while len(pending) > 0:
+            if cancellable is not None and cancellable.is_cancelled():
+                return
+            result = pending.popleft().result()
+            for filename in filenames:
+                pending.append(executor.submit(validate, filename))
+                break
+            yield result
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def validate_desktop_files(filenames=None, cancellable=None, jobs=1,
+                           stats=None):
+    """Validate each of the desktop files, or all of the installed desktop
+    files if none are specified, and yield a ValidationResult for each one
+    that is invalid. Results are yielded in the order of the filenames.
+
+    jobs sets the number of worker threads, None uses one per CPU. If a
+    ValidationStats is given, it is updated as files are validated. Stops
+    early if the Gio.Cancellable is cancelled."""
+    if jobs is None:
+        jobs = get_default_jobs()
+    if stats is None:
+        stats = ValidationStats()
+    stats.jobs = jobs
+
+    start = time.monotonic()
+    if filenames is None:
+        filenames = get_desktop_files()
+    for result in iter_validate(filenames, jobs, cancellable):
+        stats.files += 1
+        stats.elapsed = time.monotonic() - start
+        if result is not None:
+            stats.invalid += 1
+            yield result
+    stats.elapsed = time.monotonic() - start
+    record_phase("validate desktop files", start, start + stats.elapsed)
+
+
+def find_bad_desktop_files(cancellable=None, jobs=None):
+    """Return the ValidationResults for all installed desktop files that GMenu
+    can't load, sorted by filename."""
+    stats = ValidationStats()
+    results = list(validate_desktop_files(cancellable=cancellable, jobs=jobs,
+                                          stats=stats))
+    results.sort(key=lambda result: result.filename)
+    logger.debug("Validated desktop files: %s" % stats)
+    return results
@@ -15,6 +15,7 @@
 #   You should have received a copy of the GNU General Public License along
 #   with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
 import locale
 import os
 import json
@@ -24,20 +25,95 @@ import subprocess
 
 from gi.repository import GLib  # type: ignore
 
+from . import util
+
+import logging
+logger = logging.getLogger('menulibre')
+
 locale.textdomain('menulibre')
 
 
 sudo = os.getuid() == 0
 default_locale = locale.getdefaultlocale()[0]
 
+# Total size in bytes of the desktop files kept parsed by DesktopEntryCache.
+DESKTOP_ENTRY_CACHE_BUDGET = 4 * 1024 * 1024
+
+
+# Keys that are looked up in the user's language.
+LOCALE_STRING_KEYS = ["Name", "GenericName", "Comment", "Keywords"]
+
+# Keys read with MenulibreDesktopEntry.get_boolean().
+BOOLEAN_KEYS = [key[0] for key in util.MenuItemKeys if key[1] is bool]
+
+# Escape sequences of desktop file string values.
+ESCAPE_SEQUENCES = {'s': ' ', 'n': '\n', 't': '\t', 'r': '\r', '\\': '\\'}
+
+
+def get_locale_variants(locale_str):
+    """Return the locales to look up for locale_str, most specific first, as
+    in the Desktop Entry Specification: lang_COUNTRY@MODIFIER, lang_COUNTRY,
+    lang@MODIFIER and lang. Any encoding is ignored."""
+    if not locale_str:
+        return []
+    locale_str, _sep, modifier = locale_str.partition('@')
+    locale_str = locale_str.split('.')[0]
+    lang, _sep, country = locale_str.partition('_')
+    variants = []
+    if country and modifier:
+        variants.append("%s_%s@%s" % (lang, country, modifier))
+    if country:
+        variants.append("%s_%s" % (lang, country))
+    if modifier:
+        variants.append("%s@%s" % (lang, modifier))
+    variants.append(lang)
+    return variants
+
+
+def parse_value(value, separator=None):
+    """Unescape a raw desktop file value. If separator is given, the value
+    is a list and is split on the separators that are not escaped."""
+    items = []
+    chars = []
+    escaped = False
+    for char in value:
+        if escaped:
+            escaped = False
+            if char in ESCAPE_SEQUENCES:
+                chars.append(ESCAPE_SEQUENCES[char])
+            elif separator is not None and char == separator:
+                chars.append(char)
+            else:
+                chars.append('\\' + char)
+        elif char == '\\':
+            escaped = True
+        elif separator is not None and char == separator:
+            items.append("".join(chars))
+            chars = []
+        else:
+            chars.append(char)
+    if escaped:
+        chars.append('\\')
+    if separator is None:
+        return "".join(chars)
+    if len(chars) > 0:
+        items.append("".join(chars))
+    return items
+
 
 class MenulibreDesktopEntry:
 
-    """Basic class for Desktop Entry files"""
+    """Basic class for Desktop Entry files
+
+    The keys of every group are read from the keyfile in a single pass the
+    first time a value is needed, and kept in a dictionary until the entry
+    is changed. Localized values are resolved once per key and locale."""
 
     def __init__(self, filename=None):
         """Initialize the MenulibreDesktopEntry instance."""
         self.keyfile = GLib.KeyFile.new()
+        self._groups = None
+        self._localized = {}
         if filename is not None and os.path.isfile(filename):
             self.load_properties(filename)
         else:
@@ -59,7 +135,7 @@ class MenulibreDesktopEntry:
     def __setitem__(self, key, value):
         """Set property to this object like a dictionary."""
         self._set_value("Desktop Entry", key, value)
-        if key in ["Name", "GenericName", "Comment", "Keywords"]:
+        if key in LOCALE_STRING_KEYS:
             self._set_locale_string("Desktop Entry", key, default_locale,
                                     value)
 
@@ -68,39 +144,58 @@ class MenulibreDesktopEntry:
         self.keyfile = GLib.KeyFile.new()
         self.keyfile.load_from_file(filename,
                                     GLib.KeyFileFlags.KEEP_TRANSLATIONS)
+        self._invalidate()
 
     def get_property(self, category, prop_name, locale_str=default_locale):
         """Return the value of the specified property."""
+        if prop_name in BOOLEAN_KEYS:
+            return self.get_boolean(category, prop_name)
         prop = self.get_named_property(category, prop_name, locale_str)
         if prop in ['true', 'false']:
             return prop == 'true'
-        if prop_name in ['Hidden', 'NoDisplay', 'Terminal', 'StartupNotify']:
-            return False
         return prop
 
     def get_named_property(self, group, key, locale_str=None):
         """Return the value of the specified named property."""
-        if key in ["Name", "GenericName", "Comment", "Keywords"]:
+        if key in LOCALE_STRING_KEYS:
             if locale_str is not None:
                 return self._get_locale_string(group, key, locale_str)
 
-        value = self._get_value(group, key)
+        value = self._get_group(group).get(key)
 
         if value is not None:
             return value
 
         return ""
 
+    def get_boolean(self, group, key, default=False):
+        """Return the value of a boolean key, or default if it is not set."""
+        value = self._get_group(group).get(key)
+        if value in ['true', '1']:
+            return True
+        if value in ['false', '0']:
+            return False
+        return default
+
+    def get_string_list(self, group, key):
+        """Return the value of a list key, or an empty list if it is not
+        set."""
+        value = self._get_group(group).get(key)
+        if value is None:
+            return []
+        return parse_value(value, ';')
+
     def get_actions(self):
         """Return a list of the Unity action groups."""
-        if "Actions" in self._get_keys("Desktop Entry"):
+        keys = self._get_group("Desktop Entry")
+        if "Actions" in keys:
             action_key = "Actions"
-        elif "X-Ayatana-Desktop-Shortcuts" in self._get_keys("Desktop Entry"):
+        elif "X-Ayatana-Desktop-Shortcuts" in keys:
             action_key = "X-Ayatana-Desktop-Shortcuts"
         else:
             return json.dumps([])
 
-        enabled_quicklists = self._get_string_list("Desktop Entry", action_key)
+        enabled_quicklists = self.get_string_list("Desktop Entry", action_key)
 
         quicklists = []
 
@@ -127,32 +222,47 @@ class MenulibreDesktopEntry:
             return name
         return None
 
-    def _get_locale_string(self, group, key, locale_str):
-        try:
-            value = self.keyfile.get_locale_string(group, key, locale_str)
-        except GLib.Error:
-            value = None
+    def _invalidate(self):
+        """Forget the values read from the keyfile after it changes."""
+        self._groups = None
+        self._localized.clear()
+
+    def _get_group(self, group):
+        """Return a dictionary of the raw values of the keys in group. The
+        keys of all groups are read the first time this is called."""
+        if self._groups is None:
+            self._groups = {}
+            for name in self._get_groups():
+                values = {}
+                for key in self._get_keys(name):
+                    value = self._get_value(name, key)
+                    if value is not None:
+                        values[key] = value
+                self._groups[name] = values
+        return self._groups.get(group, {})
 
+    def _get_locale_string(self, group, key, locale_str):
+        cache_key = (group, key, locale_str)
+        value = self._localized.get(cache_key)
         if value is not None:
             return value
 
-        if '_' in locale_str:
-            locale_str = locale_str.split("_")[0]
-            return self._get_locale_string(group, key, locale_str)
-
-        return self._get_string(group, key)
+        values = self._get_group(group)
+        value = None
+        for variant in get_locale_variants(locale_str):
+            value = values.get("%s[%s]" % (key, variant))
+            if value is not None:
+                break
+        if value is None:
+            value = values.get(key, "")
+
+        value = parse_value(value)
+        self._localized[cache_key] = value
+        return value
 
     def _set_locale_string(self, group, key, locale_str, value):
         self.keyfile.set_locale_string(group, key, locale_str, value)
-
-    def _get_string(self, group, key):
-        try:
-            value = self.keyfile.get_string(group, key)
-        except GLib.Error:
-            value = None
-        if value is not None:
-            return value
-        return ""
+        self._invalidate()
 
     def _get_value(self, group, key):
         try:
@@ -163,15 +273,7 @@ class MenulibreDesktopEntry:
 
     def _set_value(self, group, key, value):
         self.keyfile.set_value(group, key, value)
-
-    def _get_string_list(self, group, key):
-        try:
-            value = self.keyfile.get_string_list(group, key)
-        except GLib.Error:
-            value = None
-        if value is not None:
-            return value
-        return []
+        self._invalidate()
 
     def _get_groups(self):
         try:
@@ -186,8 +288,139 @@ class MenulibreDesktopEntry:
             return []
 
 
-def desktop_menu_update():
-    subprocess.call(["xdg-desktop-menu", "forceupdate"])
+class DesktopEntryCache:
+    """Least recently used cache of parsed desktop files, so that selecting
+    a launcher again or restoring a system launcher does not read and parse
+    the file again.
+
+    Entries are checked against the modification time and size of the file on
+    every lookup, and dropped once the total size of the cached files is over
+    the budget. The returned entries are shared and must not be modified."""
+
+    def __init__(self, budget=DESKTOP_ENTRY_CACHE_BUDGET):
+        """Initialize the DesktopEntryCache with a budget in bytes."""
+        self.budget = budget
+        self._entries = collections.OrderedDict()
+        self._size = 0
+
+    def get(self, filename):
+        """Return the MenulibreDesktopEntry for filename. Missing files
+        are not cached, they return the defaults for a new launcher."""
+        try:
+            stat = os.stat(filename)
+        except (OSError, TypeError):
+            self.invalidate(filename)
+            return MenulibreDesktopEntry(filename)
+
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        cached = self._entries.get(filename)
+        if cached is not None and cached[0] == stamp:
+            self._entries.move_to_end(filename)
+            return cached[1]
+
+        self.invalidate(filename)
+        entry = MenulibreDesktopEntry(filename)
+        self._entries[filename] = (stamp, entry)
+        self._size += stat.st_size
+        while self._size > self.budget and len(self._entries) > 1:
+            oldest = next(iter(self._entries))
+            self.invalidate(oldest)
+        return entry
+
+    def invalidate(self, filename=None):
+        """Forget the entry for filename, or all entries if None."""
+        if filename is None:
+            self._entries.clear()
+            self._size = 0
+            return
+        cached = self._entries.pop(filename, None)
+        if cached is not None:
+            self._size -= cached[0][1]
+
+    def invalidate_relative(self, basenames):
+        """Forget the entries for the relative names (as returned by
+        util.getRelativeName), in any of the search paths."""
+        basenames = set(basenames)
+        for filename in list(self._entries.keys()):
+            if util.getRelativeName(filename) in basenames:
+                self.invalidate(filename)
+
+
+desktop_entry_cache = DesktopEntryCache()
+
+
+def get_desktop_entry(filename):
+    """Return the shared, read-only MenulibreDesktopEntry for filename."""
+    return desktop_entry_cache.get(filename)
+
+
+# Programs rebuilding the menu cache of desktop environments that don't watch
+# the menu files themselves, by util.getCurrentDesktop(). The first one
+# installed is used.
+MENU_CACHE_BUILDERS = {
+    "kde": ["kbuildsycoca4"],
+    "plasma": ["kbuildsycoca6", "kbuildsycoca5"],
+}
+
+
+class MenuUpdateNotifier:
+    """Tells the desktop environment about changes to the menu. Changes are
+    recorded as they are written to disk, and notify() runs the rebuild
+    commands for the current desktop once for the whole batch. Nothing is
+    run if nothing changed."""
+
+    def __init__(self, desktop=None):
+        """Initialize the MenuUpdateNotifier for the desktop environment, by
+        default the current one."""
+        if desktop is None:
+            desktop = util.getCurrentDesktop()
+        self.desktop = desktop
+        self._menu_changed = False
+        self._files_changed = False
+
+    def add_menu_change(self):
+        """Record that the applications.menu file, or an existing launcher
+        or directory file, was rewritten."""
+        self._menu_changed = True
+
+    def add_file_change(self):
+        """Record that launcher, directory or merged menu files were created
+        or removed."""
+        self._files_changed = True
+
+    def get_pending(self):
+        """Return True if there are changes not notified yet."""
+        return self._menu_changed or self._files_changed
+
+    def get_commands(self):
+        """Return the commands to run for the pending changes."""
+        if not self.get_pending():
+            return []
+
+        builders = MENU_CACHE_BUILDERS.get(self.desktop, [])
+        for builder in builders:
+            if util.find_program(builder) is not None:
+                return [[builder]]
+        if len(builders) > 0:
+            return []
+
+        # Other desktops watch the menu file, xdg-desktop-menu updates the
+        # caches of the rest after files are installed or removed.
+        if self._files_changed:
+            return [["xdg-desktop-menu", "forceupdate"]]
+        return []
+
+    def notify(self):
+        """Run the rebuild commands for the changes since the last call."""
+        commands = self.get_commands()
+        self._menu_changed = False
+        self._files_changed = False
+        for command in commands:
+            logger.debug("Notifying menu changes: %s" % " ".join(command))
+            try:
+                subprocess.Popen(command)
+            except OSError:
+                logger.warning("Failed to run %s" % command[0])
 
 
 def desktop_menu_install(directory_files, desktop_files):
@@ -234,16 +467,17 @@ def desktop_menu_install(directory_files, desktop_files):
 
 def desktop_menu_uninstall(directory_files, desktop_files):  # noqa
     """Remove applications or submenus from the desktop menu system
-    previously installed with xdg-desktop-menu install."""
+    previously installed with xdg-desktop-menu install. Return True if a
+    merged menu file was changed."""
     # Check for the minimum required arguments
     if len(directory_files) == 0 or len(desktop_files) == 0:
-        return
+        return False
 
     # Do not uninstall from system paths.
     for path in GLib.get_system_config_dirs():
         for filename in directory_files:
             if filename.startswith(path):
-                return
+                return False
 
     # xdg-desktop-menu uninstall does not work... implement ourselves.
     basenames = []
@@ -277,6 +511,5 @@ def desktop_menu_uninstall(directory_files, desktop_files):  # noqa
         if filename_found:
             found_directories.sort()
             if basenames == found_directories:
-                with open(filename, 'w') as open_file:
-                    open_file.write(write_contents)
-                return
+                return util.writeFileAtomic(filename, write_contents)
+    return False
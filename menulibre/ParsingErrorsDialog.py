@@ -84,6 +84,11 @@ class ParsingErrorsDialog(Gtk.Dialog):
         row.connect("action", self.on_row_action)
         self.listbox.add(row)
 
+    def add_results(self, results):
+        """Add a row for each MenulibreValidator.ValidationResult."""
+        for result in results:
+            self.add_item(result.filename, result.message)
+
     def on_row_action(self, row, action, filename):
         if self.demo_mode:
             print(action, filename)
@@ -25,19 +25,51 @@ except ImportError:
     from xml.etree.ElementTree import ElementTree, Element, SubElement
 # lint:enable
 
+import collections
+import io
 import os
 
 from . import util
 from .util import MenuItemTypes
 
 from . import MenuEditor
+from .MenulibreTreeWalk import iter_children
 
 # Store user desktop directory location
 directories = util.getUserDirectoriesDirectory()
 
 
-# Prevent gnome-menus crash
-processed_directories = []
+# The <Menu> element written for a directory, with the directories written
+# in it.
+CachedMenu = collections.namedtuple('CachedMenu', ['element', 'directories'])
+
+
+class MenuElementCache:
+    """The <Menu> elements written for each directory in the previous
+    serialization, keyed by directory filename. The treeview invalidates a
+    directory when any row in its subtree changes, unchanged subtrees are
+    reused instead of being rebuilt from the model.
+
+    Filenames only identify a directory if it is in the menu once, so the
+    cache is cleared after writing a menu with duplicate directories."""
+
+    def __init__(self):
+        self._menus = {}
+
+    def get(self, desktop):
+        """Return the CachedMenu for desktop, or None."""
+        return self._menus.get(desktop)
+
+    def set(self, desktop, element, directories):
+        """Store the <Menu> element written for desktop."""
+        self._menus[desktop] = CachedMenu(element, directories)
+
+    def invalidate(self, desktop=None):
+        """Rebuild desktop, or all directories if None, on the next write."""
+        if desktop is None:
+            self._menus.clear()
+        else:
+            self._menus.pop(desktop, None)
 
 
 def indent(elem, level=0):
@@ -188,7 +220,10 @@ class XmlMenuElementTree(ElementTree):
     def write(self, output_file):
         """Override for the ElementTree.write function. This variation adds
         the menu specification headers and writes the output in an
-        easier-to-read format."""
+        easier-to-read format. The file is replaced atomically, and only if
+        the contents changed.
+
+        Return True if the file was written."""
         header = """<?xml version="1.0" encoding="UTF-8" ?>
 <!DOCTYPE Menu
   PUBLIC '-//freedesktop//DTD Menu 1.0//EN'
@@ -196,27 +231,127 @@ class XmlMenuElementTree(ElementTree):
 """
         copy = self.getroot()
         indent(copy)
-        with open(output_file, 'w') as f:
-            f.write(header)
-            ElementTree(copy).write(f, encoding='unicode')
-
-
-def model_to_xml_menus(model, model_parent=None, menu_parent=None):
-    """Append the <Menu> elements to menu_parent."""
-    for n_child in range(model.iter_n_children(model_parent)):
-        treeiter = model.iter_nth_child(model_parent, n_child)
+        contents = io.StringIO()
+        contents.write(header)
+        ElementTree(copy).write(contents, encoding='unicode')
+        return util.writeFileAtomic(output_file, contents.getvalue())
+
+
+class MenuSerializer:
+    """Converts the menu model to <Menu> elements. Each serializer carries
+    the state of a single run: the directories written so far, to prevent
+    the duplicate menus that crash gnome-menus, and the names looked up for
+    each file. Separate runs share no state, so they can run concurrently.
+
+    If a MenuElementCache is given, unchanged directories are reused from the
+    previous run instead of being rebuilt."""
+
+    def __init__(self, model, cache=None):
+        self.model = model
+        self.cache = cache
+        self._processed = set()
+        # Directories written as a <Menu> element, in order. A cached
+        # subtree is a slice of it.
+        self._menus = set()
+        self._menus_order = []
+        # True once a directory has been found in the menu twice.
+        self._duplicates = False
+        self._directory_names = {}
+        self._layout_filenames = {}
+
+    def _is_processed(self, desktop):
+        """Return True if the directory has already been written."""
+        if desktop in self._processed:
+            self._duplicates = True
+            return True
+        return False
 
-        # Extract the menu item details.
-        name = model[treeiter][MenuEditor.COL_NAME]
-        item_type = model[treeiter][MenuEditor.COL_TYPE]
-        desktop = model[treeiter][MenuEditor.COL_FILENAME]
+    def _add_menus(self, desktops):
+        """Record the directories as written as a <Menu> element."""
+        for desktop in desktops:
+            self._menus.add(desktop)
+            self._menus_order.append(desktop)
+
+    def _get_directory_name(self, desktop):
+        """Return the menu name used in the XML file for a directory."""
+        name = self._directory_names.get(desktop)
+        if name is None:
+            name = util.getDirectoryName(desktop)
+            self._directory_names[desktop] = name
+        return name
+
+    def _get_layout_filename(self, desktop):
+        """Return the desktop file id used in <Layout> for a launcher."""
+        filename = self._layout_filenames.get(desktop)
+        if filename is None:
+            # According to the spec, desktop files may be located in
+            # subdirectories of the '*/applications' directory that
+            # effectively gives the contained desktop filenames an extra
+            # prefix based on that directory name (this affects me with the
+            # kde4 subdirectory desktop files). This only seems to matter
+            # for layout generation - if you don't specify the desktop file
+            # with the prefix here, the prefixed desktop file will not
+            # match in the layout node when the menu is being constructed
+            # See LP: #1315536 comment 5
+            containing_dir = os.path.basename(os.path.dirname(desktop))
+            filename = os.path.basename(desktop)
+            if containing_dir != 'applications':
+                filename = '%s-%s' % (containing_dir, filename)
+            self._layout_filenames[desktop] = filename
+        return filename
+
+    def _get_cached_menu(self, desktop):
+        """Return the cached <Menu> element for desktop if this run would
+        build the same element, or None."""
+        if self.cache is None:
+            return None
+        cached = self.cache.get(desktop)
+        if cached is None:
+            return None
+        # A directory written before this one would now be skipped.
+        if not self._processed.isdisjoint(cached.directories):
+            return None
+        if not self._menus.isdisjoint(cached.directories):
+            return None
+        return cached
+
+    def children_to_xml(self, model_parent=None, menu_parent=None):
+        """Add child menu items to menu_parent from model_parent."""
+        # Menus First...
+        self.menus_to_xml(model_parent, menu_parent)
+
+        # Includes Second... to allow for alacarte-created entries without
+        # categories to persist (see LP: #1315880)
+        self.includes_to_xml(model_parent, menu_parent)
+
+        # Layouts Third...
+        self.layout_to_xml(model_parent, menu_parent, merge=False)
+
+        if self.cache is not None and self._duplicates:
+            self.cache.invalidate()
+
+    def menus_to_xml(self, model_parent=None, menu_parent=None):
+        """Append the <Menu> elements to menu_parent."""
+        model = self.model
+        for treeiter in iter_children(model, model_parent):
+
+            # Extract the menu item details.
+            name = model[treeiter][MenuEditor.COL_NAME]
+            item_type = model[treeiter][MenuEditor.COL_TYPE]
+            desktop = model[treeiter][MenuEditor.COL_FILENAME]
+
+            if item_type != MenuItemTypes.DIRECTORY:  # type: ignore
+                continue
 
-        if item_type == MenuItemTypes.DIRECTORY:  # type: ignore
             # Do not save duplicate directories.
-            global processed_directories
-            if desktop in processed_directories:
+            if self._is_processed(desktop):
                 continue
 
+            # Directories are only marked as processed by the layout of
+            # their parent, a <Menu> for them may already have been written.
+            if desktop in self._menus:
+                self._duplicates = True
+
             # Add a menu child.
             if desktop is None:
                 # Cinnamon fix.
@@ -225,147 +360,130 @@ def model_to_xml_menus(model, model_parent=None, menu_parent=None):
                 else:
                     continue
             else:
-                directory_name = util.getDirectoryName(desktop)
+                # Reuse the unchanged subtree from the previous run.
+                cached = None
+                if desktop not in self._menus:
+                    cached = self._get_cached_menu(desktop)
+                if cached is not None:
+                    menu_parent.append(cached.element)  # type: ignore
+                    self._add_menus([desktop] + cached.directories)
+                    self._processed.update(cached.directories)
+                    continue
+
+                directory_name = self._get_directory_name(desktop)
                 next_element = menu_parent.addMenu(directory_name, desktop)  # type: ignore
 
+            self._add_menus([desktop])
+            start = len(self._menus_order)
+
             # Do Menus
-            model_to_xml_menus(model, treeiter, next_element)
+            self.menus_to_xml(treeiter, next_element)
 
             # Do Includes to allow for alacarte-created entries without
             # categories to persist (see LP: #1315880)
-            model_to_xml_includes(model, treeiter, next_element)
+            self.includes_to_xml(treeiter, next_element)
 
             # Do Layouts
-            model_to_xml_layout(model, treeiter, next_element)
-
-        elif item_type == MenuItemTypes.APPLICATION:  # type: ignore
-            pass
+            self.layout_to_xml(treeiter, next_element)
 
-        elif item_type == MenuItemTypes.SEPARATOR:  # type: ignore
-            pass
+            if self.cache is not None and desktop is not None:
+                self.cache.set(desktop, next_element,
+                               self._menus_order[start:])
 
+    def includes_to_xml(self, model_parent=None, menu_parent=None):
+        """Append <Include> elements for any application items that lack
+        categories in a system directory (e.g. alacarte-created entries), and
+        all items in custom directories."""
+        model = self.model
 
-def model_to_xml_includes(model, model_parent=None, menu_parent=None):
-    """Append <Include> elements for any application items that lack categories
-    in a system directory (e.g. alacarte-created entries), and all items in
-    custom directories."""
+        # Looping for all items in directory
+        for treeiter in iter_children(model, model_parent):
 
-    # Looping for all items in directory
-    for n_child in range(model.iter_n_children(model_parent)):
-        treeiter = model.iter_nth_child(model_parent, n_child)
+            # Extract the menu item details.
+            categories = model[treeiter][MenuEditor.COL_CATEGORIES]
+            item_type = model[treeiter][MenuEditor.COL_TYPE]
+            desktop = model[treeiter][MenuEditor.COL_FILENAME]
 
-        # Extract the menu item details.
-        categories = model[treeiter][MenuEditor.COL_CATEGORIES]
-        item_type = model[treeiter][MenuEditor.COL_TYPE]
-        desktop = model[treeiter][MenuEditor.COL_FILENAME]
-
-        if desktop is None:
-            continue
-
-        # Detecting custom user directories
-        user_directory = False
-        if model_parent and categories:
-            for category in categories.split(';'):
-                if category.startswith('menulibre-'):
-                    user_directory = True
-                    break
-
-        # Items in custom directories by menulibre have a category, but
-        # includes are required otherwise they are dropped by GMenu
-        if item_type == MenuItemTypes.APPLICATION and (  # type: ignore
-                not categories or user_directory):
-            include = menu_parent.addInclude()  # type: ignore
-            try:
-                include.addFilename(os.path.basename(desktop))
-            except AttributeError:
-                pass
-
-
-def model_to_xml_layout(model, model_parent=None, menu_parent=None,  # noqa
-                        merge=True):
-    """Append the <Layout> element to menu_parent."""
-    layout = menu_parent.addLayout()  # type: ignore
-
-    # Add a merge for any submenus (except toplevel)
-    if merge:
-        layout.addMerge("menus")
-
-    for n_child in range(model.iter_n_children(model_parent)):
-        treeiter = model.iter_nth_child(model_parent, n_child)
-
-        # Extract the menu item details.
-        name = model[treeiter][MenuEditor.COL_NAME]
-        item_type = model[treeiter][MenuEditor.COL_TYPE]
-        desktop = model[treeiter][MenuEditor.COL_FILENAME]
-
-        if item_type == MenuItemTypes.DIRECTORY:  # type: ignore
-            # Do not save duplicate directories.
-            global processed_directories
-            if desktop in processed_directories:
+            if desktop is None:
                 continue
-            else:
-                processed_directories.append(desktop)
 
-            if desktop is None:
-                # Cinnamon fix.
-                if name == 'wine-wine':
-                    layout.addMenuname(name)
-                else:
+            # Detecting custom user directories
+            user_directory = False
+            if model_parent and categories:
+                for category in categories.split(';'):
+                    if category.startswith('menulibre-'):
+                        user_directory = True
+                        break
+
+            # Items in custom directories by menulibre have a category, but
+            # includes are required otherwise they are dropped by GMenu
+            if item_type == MenuItemTypes.APPLICATION and (  # type: ignore
+                    not categories or user_directory):
+                include = menu_parent.addInclude()  # type: ignore
+                try:
+                    include.addFilename(os.path.basename(desktop))
+                except AttributeError:
+                    pass
+
+    def layout_to_xml(self, model_parent=None, menu_parent=None,  # noqa
+                      merge=True):
+        """Append the <Layout> element to menu_parent."""
+        model = self.model
+        layout = menu_parent.addLayout()  # type: ignore
+
+        # Add a merge for any submenus (except toplevel)
+        if merge:
+            layout.addMerge("menus")
+
+        for treeiter in iter_children(model, model_parent):
+
+            # Extract the menu item details.
+            name = model[treeiter][MenuEditor.COL_NAME]
+            item_type = model[treeiter][MenuEditor.COL_TYPE]
+            desktop = model[treeiter][MenuEditor.COL_FILENAME]
+
+            if item_type == MenuItemTypes.DIRECTORY:  # type: ignore
+                # Do not save duplicate directories.
+                if self._is_processed(desktop):
                     continue
-            else:
-                directory_name = util.getDirectoryName(desktop)
-                layout.addMenuname(directory_name)
-
-        elif item_type == MenuItemTypes.APPLICATION and desktop is not None:  # type: ignore
-            try:
-
-                # According to the spec, desktop files may be located in
-                # subdirectories of the '*/applications' directory that
-                # effectively gives the contained desktop filenames an extra
-                # prefix based on that directory name (this affects me with the
-                # kde4 subdirectory desktop files). This only seems to matter
-                # for layout generation - if you don't specify the desktop file
-                # with the prefix here, the prefixed desktop file will not
-                # match in the layout node when the menu is being constructed
-                # See LP: #1315536 comment 5
-                containing_dir = os.path.basename(os.path.dirname(desktop))
-                desktop_filename = os.path.basename(desktop)
-                if containing_dir != 'applications':
-                    desktop_filename = '%s-%s' % (containing_dir,
-                                                  desktop_filename)
-                layout.addFilename(desktop_filename)
-            except AttributeError:
-                pass
-
-        elif item_type == MenuItemTypes.SEPARATOR:  # type: ignore
-            layout.addSeparator()
-
-    # Add a merge for any new/unincluded menu items (except toplevel).
-    if merge:
-        layout.addMerge("files")
-
-    return layout
-
-
-def model_children_to_xml(model, model_parent=None, menu_parent=None):
-    """Add child menu items to menu_parent from model_parent."""
-    # Prevent menu duplication that crashes gnome-menus
-    global processed_directories
-    processed_directories = []
+                self._processed.add(desktop)
+
+                if desktop is None:
+                    # Cinnamon fix.
+                    if name == 'wine-wine':
+                        layout.addMenuname(name)
+                    else:
+                        continue
+                else:
+                    layout.addMenuname(self._get_directory_name(desktop))
 
-    # Menus First...
-    model_to_xml_menus(model, model_parent, menu_parent)
+            elif item_type == MenuItemTypes.APPLICATION and desktop is not None:  # type: ignore
+                try:
+                    layout.addFilename(self._get_layout_filename(desktop))
+                except AttributeError:
+                    pass
 
-    # Includes Second... to allow for alacarte-created entries without
-    # categories to persist (see LP: #1315880)
-    model_to_xml_includes(model, model_parent, menu_parent)
+            elif item_type == MenuItemTypes.SEPARATOR:  # type: ignore
+                layout.addSeparator()
 
-    # Layouts Third...
-    model_to_xml_layout(model, model_parent, menu_parent, merge=False)
+        # Add a merge for any new/unincluded menu items (except toplevel).
+        if merge:
+            layout.addMerge("files")
 
+        return layout
 
-def treeview_to_xml(treeview):
-    """Write the current treeview to the -applications.menu file."""
+
+def model_children_to_xml(model, model_parent=None, menu_parent=None,
+                          cache=None):
+    """Add child menu items to menu_parent from model_parent."""
+    MenuSerializer(model, cache).children_to_xml(model_parent, menu_parent)
+
+
+def treeview_to_xml(treeview, cache=None):
+    """Write the current treeview to the -applications.menu file. If a
+    MenuElementCache is given, only the changed directories are rebuilt.
+
+    Return True if the file was changed."""
     model = treeview.get_model()
 
     # Get the necessary details
@@ -381,9 +499,7 @@ def treeview_to_xml(treeview):
     # Create the menu XML
     menu = XmlMenuElementTree(menu_name, merge_file)
     root = menu.getroot()
-    model_children_to_xml(model, menu_parent=root)
+    model_children_to_xml(model, menu_parent=root, cache=cache)
 
     # Write the file.
-    menu.write(filename)
-
-    return True
\ No newline at end of file
+    return menu.write(filename)
\ No newline at end of file
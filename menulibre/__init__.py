@@ -20,9 +20,11 @@ import sys
 
 from locale import gettext as _
 
-from menulibre import MenulibreApplication
+# Imported first so that the startup timings include the other imports.
+from menulibre_lib import set_up_logging, get_version, timed_phase
 
-from menulibre_lib import set_up_logging, get_version
+with timed_phase("import modules"):
+    from menulibre import MenulibreApplication
 
 
 def parse_options():
@@ -42,6 +44,18 @@ def parse_options():
         # Translators: Command line option to switch layout
         help=_("Use toolbar layout (server side decorations)")
     )
+    parser.add_option(
+        "--profile-startup", action="store_true", dest="profile_startup",
+        default=False,
+        # Translators: Command line option to report startup timings
+        help=_("Print a JSON breakdown of the startup time once the menu has "
+               "loaded")
+    )
+    parser.add_option(
+        "--profile-output", dest="profile_output", metavar="FILE",
+        # Translators: Command line option to save startup timings to a file
+        help=_("Write the startup timings to FILE instead of stdout")
+    )
     (options, args) = parser.parse_args()
 
     set_up_logging(options)
@@ -59,6 +73,9 @@ def main():
         app.use_headerbar = True
     elif opts.toolbar is not None:
         app.use_toolbar = True
+    if opts.profile_startup or opts.profile_output is not None:
+        app.profile_startup = True
+        app.profile_output = opts.profile_output
 
     exit_status = app.run(None)
     sys.exit(exit_status)
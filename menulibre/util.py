@@ -16,10 +16,13 @@
 #   You should have received a copy of the GNU General Public License along
 #   with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
+import locale
 import logging
 import os
 import re
-import subprocess
+import threading
+import time
 
 import getpass
 import psutil
@@ -35,6 +38,18 @@ logger = logging.getLogger('menulibre')
 
 old_psutil_format = isinstance(psutil.Process.username, property)
 
+# Panel processes used to identify the running desktop environment.
+SESSION_PROCESSES = ['mate-panel', 'unity', 'xfce4-panel']
+
+# Desktop environment details, detected once per session.
+session_cache = {}
+
+# Seconds between checks for changes to the indexed search paths.
+PATH_INDEX_INTERVAL = 1.0
+
+# User directories that have already been created this session.
+ensured_directories = set()
+
 
 def enum(**enums):
     """Add enumerations to Python."""
@@ -49,6 +64,18 @@ MenuItemTypes = enum(
 )
 
 
+ValidationErrors = enum(
+    NONE=0,
+    SKIPPED=1,
+    LOAD_FAILED=2,
+    INVALID_START_GROUP=3,
+    MISSING_TYPE=4,
+    INVALID_TYPE=5,
+    EXEC_NOT_FOUND=6,
+    INVALID_EXEC=7
+)
+
+
 MenuItemKeys = (
     # Key, Type, Required, Types (MenuItemType)
     ("Version", str, False, (0, 1, 2)),
@@ -156,6 +183,48 @@ def getProcessList():
     return processes
 
 
+def findProcesses(names):
+    """Return the set of the given process names that are running for the
+    current user. Only the names of interest are compared, using a single
+    scan of /proc where available."""
+    names = set(names)
+    if not os.path.isdir('/proc/self'):
+        return names.intersection(getProcessList())
+
+    uid = os.getuid()
+    found = set()
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        path = os.path.join('/proc', pid)
+        try:
+            if os.stat(path).st_uid != uid:
+                continue
+            with open(os.path.join(path, 'comm'), 'r') as comm:
+                p_name = comm.read().strip()
+        except OSError:
+            continue
+        if p_name in names:
+            found.add(p_name)
+            if found == names:
+                break
+    return found
+
+
+def getSessionProcesses():
+    """Return the set of desktop panel processes running for the current
+    user. This is only detected once, see invalidateSessionCache()."""
+    if 'processes' not in session_cache:
+        session_cache['processes'] = findProcesses(SESSION_PROCESSES)
+    return session_cache['processes']
+
+
+def invalidateSessionCache():
+    """Forget the detected panel processes and default menu prefix, so they
+    are detected again the next time they are needed."""
+    session_cache.clear()
+
+
 def getRelativeName(filename: str):
     if filename.endswith('.desktop'):
         basename = filename.split('/applications/', 1)[1]
@@ -178,6 +247,27 @@ def getBasename(filename: str):
     return basename
 
 
+# Sort keys for menu item names, see getCollationKey().
+collation_keys = {}
+COLLATION_CACHE_SIZE = 4096
+
+
+def getCollationKey(text):
+    """Return a key to sort text case-insensitively in the order of the
+    current locale. Keys are cached, as locale.strxfrm() is slow and the same
+    names are sorted again whenever a directory is sorted."""
+    key = collation_keys.get(text)
+    if key is None:
+        try:
+            key = locale.strxfrm(text.casefold())
+        except ValueError:
+            key = text.casefold()
+        if len(collation_keys) >= COLLATION_CACHE_SIZE:
+            collation_keys.clear()
+        collation_keys[text] = key
+    return key
+
+
 def getCurrentDesktop():
     current_desktop = os.environ.get("XDG_CURRENT_DESKTOP", "")
     current_desktop = current_desktop.lower()
@@ -199,8 +289,17 @@ def getDefaultMenuName():
     return prefix
 
 
-def getDefaultMenuPrefix():  # noqa
-    """Return the default menu prefix."""
+def getDefaultMenuPrefix():
+    """Return the default menu prefix. This is only detected once, see
+    invalidateSessionCache()."""
+    if 'prefix' not in session_cache:
+        session_cache['prefix'] = detectDefaultMenuPrefix()
+    return session_cache['prefix']
+
+
+def detectDefaultMenuPrefix():  # noqa
+    """Detect the default menu prefix from the environment and the running
+    desktop panel."""
     prefix = os.environ.get('XDG_MENU_PREFIX', '')
 
     # Cinnamon and MATE don't set this variable
@@ -221,7 +320,7 @@ def getDefaultMenuPrefix():  # noqa
             prefix = 'kde4-'
 
     if prefix == "":
-        processes = getProcessList()
+        processes = getSessionProcesses()
         if 'xfce4-panel' in processes:
             prefix = 'xfce-'
         elif 'mate-panel' in processes:
@@ -265,6 +364,78 @@ def getMenuDiagnostics():
     return diagnostics
 
 
+class PathIndex:
+    """Index of the files in a list of search paths, mapping the name
+    relative to the search path to the full path. As with a lookup in each
+    path, the first search path containing a file wins.
+
+    The index is built on first use and rebuilt when the mtime of any of the
+    indexed directories changes. This is checked at most once every
+    PATH_INDEX_INTERVAL seconds, call invalidate() after making changes."""
+
+    def __init__(self, get_search_paths):
+        self._get_search_paths = get_search_paths
+        self._lock = threading.Lock()
+        self._index = {}
+        self._stamps = None
+        self._checked = 0.0
+
+    def lookup(self, file_id):
+        """Return the path to file_id, or None if it is not installed."""
+        with self._lock:
+            now = time.monotonic()
+            if self._stamps is None:
+                self._build()
+                self._checked = now
+            elif now - self._checked >= PATH_INDEX_INTERVAL:
+                if self._stamps != self._get_stamps():
+                    self._build()
+                self._checked = now
+            return self._index.get(file_id)
+
+    def invalidate(self):
+        """Rebuild the index on the next lookup."""
+        with self._lock:
+            self._stamps = None
+
+    def _get_stamps(self):
+        """Return the current mtimes of the indexed directories."""
+        results = {}
+        for path in self._stamps.keys():
+            try:
+                results[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                results[path] = None
+        return results
+
+    def _build(self):
+        """Index every file in the search paths and their subdirectories."""
+        self._index = {}
+        self._stamps = {}
+        for search_path in self._get_search_paths():
+            self._scan(search_path, search_path)
+
+    def _scan(self, search_path, path):
+        """Index the files in path, recursing into subdirectories."""
+        try:
+            self._stamps[path] = os.stat(path).st_mtime_ns
+            entries = list(os.scandir(path))
+        except OSError:
+            # Watch missing search paths in case they are created later.
+            self._stamps[path] = None
+            return
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    self._scan(search_path, entry.path)
+                elif entry.is_file():
+                    file_id = os.path.relpath(entry.path, search_path)
+                    if file_id not in self._index:
+                        self._index[file_id] = entry.path
+            except OSError:
+                continue
+
+
 def getItemSearchPaths():
     search_paths = []
     for path in GLib.get_system_data_dirs():
@@ -274,19 +445,72 @@ def getItemSearchPaths():
 
 def getItemPath(file_id):
     """Return the path to the system-installed .desktop file."""
-    for path in getItemSearchPaths():
-        file_path = os.path.join(path, file_id)
-        if os.path.isfile(file_path):
-            return file_path
-    return None
+    return item_path_index.lookup(file_id)
+
+
+def ensureDirectory(path):
+    """Create the user directory if needed, return the path. Only checked
+    once per session."""
+    if path not in ensured_directories:
+        os.makedirs(path, exist_ok=True)
+        ensured_directories.add(path)
+    return path
+
+
+def writeFileAtomic(filename, contents):
+    """Replace the contents of filename without ever leaving a partially
+    written file: the contents are written to a temporary file in the same
+    directory, synced to disk and renamed over the original. Symbolic links
+    are followed, and the permissions of an existing file are kept.
+
+    Return False without writing if the file already has these contents,
+    True otherwise. Raises OSError if the file can't be written."""
+    if isinstance(contents, str):
+        contents = contents.encode('utf-8')
+    filename = os.path.realpath(filename)
+
+    try:
+        with open(filename, 'rb') as current:
+            if current.read() == contents:
+                return False
+        mode = os.stat(filename).st_mode & 0o7777
+    except OSError:
+        mode = None
+
+    tmp_filename = "%s.%i.tmp" % (filename, os.getpid())
+    try:
+        fd = os.open(tmp_filename,
+                     os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        with os.fdopen(fd, 'wb') as tmp:
+            tmp.write(contents)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        if mode is not None:
+            os.chmod(tmp_filename, mode)
+        os.replace(tmp_filename, filename)
+    except OSError:
+        try:
+            os.remove(tmp_filename)
+        except OSError:
+            pass
+        raise
+
+    # Sync the rename itself.
+    try:
+        fd = os.open(os.path.dirname(filename), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+    return True
 
 
 def getUserApplicationsDirectory():
     """Return the path to the user applications directory."""
-    item_dir = os.path.join(GLib.get_user_data_dir(), 'applications')
-    if not os.path.isdir(item_dir):
-        os.makedirs(item_dir)
-    return item_dir
+    return ensureDirectory(
+        os.path.join(GLib.get_user_data_dir(), 'applications'))
 
 
 def getUserItemPath(file_id):
@@ -307,29 +531,71 @@ def getDirectorySearchPaths():
 
 def getDirectoryPath(file_id):
     """Return the path to the system-installed .directory file."""
-    for path in getDirectorySearchPaths():
-        file_path = os.path.join(path, file_id)
-        if os.path.isfile(file_path):
-            return file_path
+    return directory_path_index.lookup(file_id)
+
+
+def getDirectoryMappingFilename(menu):
+    """Return the filename of the manifest of mapped desktop directories."""
+    return os.path.join(getUserCacheDirectory(), "directories-%s.json" % menu)
+
+
+def getDirectoryMappingSources(menu):
+    """Return the mtimes of the directories the desktop directories are
+    mapped from, used to detect when the mapping needs to be rebuilt."""
+    paths = getDirectorySearchPaths()
+    for path in GLib.get_system_data_dirs():
+        paths.append(os.path.join(path, menu, 'desktop-directories'))
+
+    sources = {}
+    for path in paths:
+        try:
+            sources[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            sources[path] = None
+    return sources
+
+
+def loadDirectoryMapping(menu):
+    """Return the manifest of mapped desktop directories, or None."""
+    filename = getDirectoryMappingFilename(menu)
+    try:
+        with open(filename, 'r', encoding='utf-8') as manifest:
+            mapping = json.load(manifest)
+        if isinstance(mapping.get('sources'), dict) and \
+                isinstance(mapping.get('mapped'), dict):
+            return mapping
+    except (OSError, ValueError, AttributeError):
+        pass
     return None
 
 
-def mapDesktopEnvironmentDirectories():
-    """
-    This feels wrong, but to make GMenu correctly handle desktop directories
-    in subdirectories, we need to bring them up to the top level.
-    """
-    menu = getDefaultMenuName()
-    if len(menu) == 0:
-        return
+def saveDirectoryMapping(menu, mapping):
+    """Store the manifest of mapped desktop directories."""
+    filename = getDirectoryMappingFilename(menu)
+    tmp_filename = "%s.%i.tmp" % (filename, os.getpid())
+    try:
+        with open(tmp_filename, 'w', encoding='utf-8') as manifest:
+            json.dump(mapping, manifest)
+        os.replace(tmp_filename, filename)
+    except OSError:
+        logger.warning("Failed to write %s" % filename)
+        try:
+            os.remove(tmp_filename)
+        except OSError:
+            pass
+
 
-    file_ids = []
+def findDesktopEnvironmentDirectories(menu):
+    """Return a dictionary of the desktop directory filenames that are only
+    installed in a desktop environment subdirectory, and the directory they
+    are installed in."""
+    file_ids = set()
     for path in getDirectorySearchPaths():
         if not os.path.exists(path):
             continue
         for filename in os.listdir(path):
             if filename.endswith(".desktop"):
-                file_ids.append(filename)
+                file_ids.add(filename)
 
     de_paths = {}
     for path in GLib.get_system_data_dirs():
@@ -339,17 +605,71 @@ def mapDesktopEnvironmentDirectories():
         for filename in os.listdir(de_path):
             if filename not in file_ids:
                 de_paths[filename] = de_path
+    return de_paths
 
-    user_dir = getUserDirectoriesDirectory()
-    for filename, basedir in de_paths.items():
-        if filename in file_ids:
-            continue
 
-        target_dir = os.path.join(user_dir, menu)
+def isMappedDirectoryLink(filename, de_dir):
+    """Return True if filename is a symlink to a copy in de_dir, made by
+    mapDesktopEnvironmentDirectories()."""
+    if not filename.endswith(".directory"):
+        return False
+    if not os.path.islink(filename):
+        return False
+    return os.path.realpath(filename).startswith(
+        os.path.realpath(de_dir) + os.sep)
+
+
+def removeMappedDirectoryLinks(user_dir, de_dir, filenames):
+    """Remove the mapped symlinks among filenames in user_dir."""
+    for filename in filenames:
+        filename = os.path.join(user_dir, filename)
+        if not isMappedDirectoryLink(filename, de_dir):
+            continue
         try:
-            os.makedirs(target_dir)
+            os.remove(filename)
         except BaseException:
+            logger.warning("Failed to remove symlink %s" % filename)
+
+
+def mapDesktopEnvironmentDirectories():
+    """
+    This feels wrong, but to make GMenu correctly handle desktop directories
+    in subdirectories, we need to bring them up to the top level.
+
+    What was mapped is recorded in a manifest with the mtimes of the source
+    directories. While those are unchanged, the directories are not listed
+    again, and the copies and symlinks from the previous run are kept (see
+    unmapDesktopEnvironmentDirectories), so only missing ones are recreated.
+    When the sources change, the links for files no longer mapped are
+    removed.
+    """
+    menu = getDefaultMenuName()
+    if len(menu) == 0:
+        return
+
+    user_dir = getUserDirectoriesDirectory()
+    target_dir = os.path.join(user_dir, menu)
+
+    sources = getDirectoryMappingSources(menu)
+    mapping = loadDirectoryMapping(menu)
+    if mapping is not None and mapping['sources'] == sources:
+        de_paths = mapping['mapped']
+    else:
+        de_paths = findDesktopEnvironmentDirectories(menu)
+        if mapping is not None:
+            removeMappedDirectoryLinks(
+                user_dir, target_dir,
+                [filename for filename in mapping['mapped']
+                 if filename not in de_paths])
+        saveDirectoryMapping(menu, {'sources': sources, 'mapped': de_paths})
+
+    if len(de_paths) > 0:
+        try:
+            os.makedirs(target_dir, exist_ok=True)
+        except OSError:
             pass
+
+    for filename, basedir in de_paths.items():
         target = os.path.join(target_dir, filename)
         src = os.path.join(basedir, filename)
         if not os.path.exists(target):
@@ -362,7 +682,12 @@ def mapDesktopEnvironmentDirectories():
 
         try:
             symlink = os.path.join(user_dir, filename)
-            if os.path.exists(symlink):
+            # Replace links left by the mapping of another menu.
+            if os.path.islink(symlink) and \
+                    os.path.realpath(symlink) != os.path.realpath(target) and \
+                    isMappedDirectoryLink(symlink, user_dir):
+                os.remove(symlink)
+            if os.path.lexists(symlink):
                 continue
             os.symlink(target, symlink)
         except BaseException:
@@ -373,6 +698,10 @@ def unmapDesktopEnvironmentDirectories():
     """
     This feels wrong, but to make GMenu correctly handle desktop directories
     in subdirectories, we need to bring them up to the top level.
+
+    While the manifest matches the source directories, the symlinks are kept
+    for the next run and only those whose copy has gone are removed.
+    Otherwise all of the mapped symlinks are removed.
     """
     menu = getDefaultMenuName()
     if len(menu) == 0:
@@ -384,30 +713,27 @@ def unmapDesktopEnvironmentDirectories():
     if not os.path.exists(de_dir):
         return
 
-    for filename in os.listdir(user_dir):
-        filename = os.path.join(user_dir, filename)
+    mapping = loadDirectoryMapping(menu)
+    if mapping is None:
+        removeMappedDirectoryLinks(user_dir, de_dir, os.listdir(user_dir))
+        return
 
-        if not filename.endswith(".directory"):
-            continue
-        if not os.path.islink(filename):
-            continue
+    filenames = list(mapping['mapped'].keys())
+    if mapping['sources'] != getDirectoryMappingSources(menu):
+        removeMappedDirectoryLinks(user_dir, de_dir, filenames)
+        return
 
-        realpath = os.path.realpath(filename)
-        if not realpath.startswith(de_dir):
-            continue
-
-        try:
-            os.remove(filename)
-        except BaseException:
-            logger.warning("Failed to remove symlink %s" % filename)
+    # Dangling symlinks only.
+    removeMappedDirectoryLinks(
+        user_dir, de_dir,
+        [filename for filename in filenames
+         if not os.path.exists(os.path.join(user_dir, filename))])
 
 
 def getUserDirectoriesDirectory():
     """Return the path to the user desktop-directories directory."""
-    menu_dir = os.path.join(GLib.get_user_data_dir(), 'desktop-directories')
-    if not os.path.isdir(menu_dir):
-        os.makedirs(menu_dir)
-    return menu_dir
+    return ensureDirectory(
+        os.path.join(GLib.get_user_data_dir(), 'desktop-directories'))
 
 
 def getUserDirectoryPath(file_id):
@@ -421,10 +747,13 @@ def getUserDirectoryPath(file_id):
 
 def getUserMenusDirectory():
     """Return the path to the user menus directory."""
-    menu_dir = os.path.join(GLib.get_user_config_dir(), 'menus')
-    if not os.path.isdir(menu_dir):
-        os.makedirs(menu_dir)
-    return menu_dir
+    return ensureDirectory(os.path.join(GLib.get_user_config_dir(), 'menus'))
+
+
+def getUserCacheDirectory():
+    """Return the path to the user menulibre cache directory."""
+    return ensureDirectory(
+        os.path.join(GLib.get_user_cache_dir(), 'menulibre'))
 
 
 def getUserLauncherPath(basename):
@@ -435,13 +764,29 @@ def getUserLauncherPath(basename):
         return getUserDirectoryPath(basename)
 
 
+def getMenuSearchPaths():
+    search_paths = []
+    for path in GLib.get_system_config_dirs():
+        search_paths.append(os.path.join(path, 'menus'))
+    return search_paths
+
+
 def getSystemMenuPath(file_id):
     """Return the path to the system-installed menu file."""
-    for path in GLib.get_system_config_dirs():
-        file_path = os.path.join(path, 'menus', file_id)
-        if os.path.isfile(file_path):
-            return file_path
-    return None
+    return menu_path_index.lookup(file_id)
+
+
+item_path_index = PathIndex(getItemSearchPaths)
+directory_path_index = PathIndex(getDirectorySearchPaths)
+menu_path_index = PathIndex(getMenuSearchPaths)
+
+
+def invalidatePathCache():
+    """Rebuild the system launcher, directory and menu indexes on the next
+    lookup, and check that the user directories still exist."""
+    for index in [item_path_index, directory_path_index, menu_path_index]:
+        index.invalidate()
+    ensured_directories.clear()
 
 
 def getSystemLauncherPath(basename):
@@ -722,35 +1067,6 @@ def check_keypress(event, keys):  # noqa
     return True
 
 
-def determine_bad_desktop_files():
-    """Run the gmenu-invalid-desktop-files script to get at the GMenu library's
-    debug output, which lists files that failed to load, and return these as a
-    sorted list."""
-
-    # Run the helper script with normal binary lookup via the shell, capturing
-    # stderr, sensitive to errors
-    try:
-        result = subprocess.run(['menulibre-menu-validate'],
-                                stderr=subprocess.PIPE, shell=True, check=True)
-    except subprocess.CalledProcessError:
-        return []
-
-    # stderr is returned as bytes, so converting it to the line-buffered output
-    # I actually want
-    bad_desktop_files = []
-    for line in result.stderr.decode('UTF-8').split('\n'):
-        matches = re.match(r'^Failed to load "(.+\.desktop)"$', line)
-        if matches:
-            desktop_file = matches.groups()[0]
-            if validate_desktop_file(desktop_file):
-                bad_desktop_files.append(matches.groups()[0])
-
-    # Alphabetical sort on bad desktop file paths
-    bad_desktop_files.sort()
-
-    return bad_desktop_files
-
-
 def find_program(program):
     program = program.strip()
     if len(program) == 0:
@@ -769,9 +1085,11 @@ def find_program(program):
     return None
 
 
-def validate_desktop_file(desktop_file):  # noqa
-    """Validate a known-bad desktop file in the same way GMenu/glib does, to
-    give a user real information about why certain files are broken."""
+def get_desktop_file_error(desktop_file):  # noqa
+    """Check a desktop file in the same way GMenu/glib does. Return a tuple of
+    the ValidationErrors code and a message describing the first problem
+    found. Valid files return (NONE, None), and files that are intentionally
+    not shown in the menu return (SKIPPED, None)."""
 
     # This is a reimplementation of the validation logic in glib2's
     # gio/gdesktopappinfo.c:g_desktop_app_info_load_from_keyfile.
@@ -791,8 +1109,9 @@ def validate_desktop_file(desktop_file):  # noqa
         # Translators: This error is displayed when a desktop file cannot
         # be correctly read by MenuLibre. A (possibly untranslated) error
         # code is displayed.
-        return _('Unable to load desktop file due to the following error:'
-                 ' %s') % e
+        return (ValidationErrors.LOAD_FAILED,  # type: ignore
+                _('Unable to load desktop file due to the following error:'
+                  ' %s') % e)
 
     # File is at least a valid keyfile, so can start the real desktop
     # validation
@@ -806,7 +1125,8 @@ def validate_desktop_file(desktop_file):  # noqa
         # Translators: This error is displayed when the first group in a
         # failing desktop file is incorrect. "Start group" can be safely
         # translated.
-        return (_('Start group is invalid - currently \'%s\', should be '
+        return (ValidationErrors.INVALID_START_GROUP,  # type: ignore
+                _('Start group is invalid - currently \'%s\', should be '
                   '\'%s\'') % (start_group, GLib.KEY_FILE_DESKTOP_GROUP))
 
     # Type validation
@@ -816,7 +1136,8 @@ def validate_desktop_file(desktop_file):  # noqa
     except GLib.Error:
         # Translators: This error is displayed when a required key is
         # missing in a failing desktop file.
-        return _('%s key not found') % 'Type'
+        return (ValidationErrors.MISSING_TYPE,  # type: ignore
+                _('%s key not found') % 'Type')
 
     valid_type_keys = [
         GLib.KEY_FILE_DESKTOP_TYPE_APPLICATION,
@@ -829,7 +1150,8 @@ def validate_desktop_file(desktop_file):  # noqa
     if type_key not in valid_type_keys:
         # Translators: This error is displayed when a failing desktop file
         # has an invalid value for the provided key.
-        return (_('%s value is invalid - currently \'%s\', should be \'%s\'')
+        return (ValidationErrors.INVALID_TYPE,  # type: ignore
+                _('%s value is invalid - currently \'%s\', should be \'%s\'')
                 % ('Type', type_key, GLib.KEY_FILE_DESKTOP_TYPE_APPLICATION))
 
     # Validating 'try exec' if its present
@@ -845,29 +1167,31 @@ def validate_desktop_file(desktop_file):  # noqa
     else:
         try:
             if len(try_exec) > 0 and find_program(try_exec) is None:
-                return False
+                return (ValidationErrors.SKIPPED, None)  # type: ignore
         except Exception as e:
-            return False
+            return (ValidationErrors.SKIPPED, None)  # type: ignore
 
     # Validating executable
     try:
         exec_key = keyfile.get_string(start_group,  # type: ignore
                                       GLib.KEY_FILE_DESKTOP_KEY_EXEC)
     except GLib.Error:
-        return False  # LP: #1788814, Exec key is not required
+        # LP: #1788814, Exec key is not required
+        return (ValidationErrors.SKIPPED, None)  # type: ignore
 
     try:
         if find_program(exec_key) is None:
-            return (_('%s program \'%s\' has not been found in the PATH')
+            return (ValidationErrors.EXEC_NOT_FOUND,  # type: ignore
+                    _('%s program \'%s\' has not been found in the PATH')
                     % ('Exec', exec_key))
     except Exception as e:
-        return (_('%s program \'%s\' is not a valid shell command '
+        return (ValidationErrors.INVALID_EXEC,  # type: ignore
+                _('%s program \'%s\' is not a valid shell command '
                   'according to GLib.shell_parse_argv, error: %s')
                 % ('Exec', exec_key, e))
 
     if type_key == "Service":
-        return False  # KDE services are not displayed in the menu
+        # KDE services are not displayed in the menu
+        return (ValidationErrors.SKIPPED, None)  # type: ignore
 
-    # Translators: This error is displayed for a failing desktop file where
-    # errors were detected but the file seems otherwise valid.
-    return _('Unknown error. Desktop file appears to be valid.')
+    return (ValidationErrors.NONE, None)  # type: ignore
@@ -21,4 +21,6 @@ while keeping its api constant'''
 # lint:disable
 from . helpers import set_up_logging, show_uri  # noqa
 from . menulibreconfig import get_version  # noqa
+from . timing import timed_phase, record_phase, mark_time  # noqa
+from . timing import get_timing_report, write_timing_report  # noqa
 # lint:enable
@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+#   MenuLibre - Advanced fd.o Compliant Menu Editor
+#   Copyright (C) 2012-2024 Sean Davis <sean@bluesabre.org>
+#
+#   This program is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License version 3, as published
+#   by the Free Software Foundation.
+#
+#   This program is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranties of
+#   MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+#   PURPOSE.  See the GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Lightweight phase timer for startup profiling.
+
+Phases are always recorded, as some of them run at import time before the
+command line has been parsed. Times are in seconds relative to the import
+of this module.'''
+
+import contextlib
+import json
+import sys
+import threading
+import time
+
+_origin = time.monotonic()
+_lock = threading.Lock()
+_phases = []
+_marks = {}
+
+
+@contextlib.contextmanager
+def timed_phase(name):
+    """Record the time spent in the with block as the named phase."""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        record_phase(name, start, time.monotonic())
+
+
+def record_phase(name, start, end):
+    """Record a phase from monotonic start and end times."""
+    with _lock:
+        _phases.append({
+            'name': name,
+            'start': round(start - _origin, 6),
+            'duration': round(end - start, 6),
+            'thread': threading.current_thread().name,
+        })
+
+
+def mark_time(name):
+    """Record the first time a named event, such as the first paint, was
+    reached."""
+    with _lock:
+        if name not in _marks:
+            _marks[name] = round(time.monotonic() - _origin, 6)
+
+
+def get_timing_report():
+    """Return the recorded phases and marks, with the total time spent in
+    each phase name."""
+    with _lock:
+        phases = list(_phases)
+        marks = dict(_marks)
+
+    totals = {}
+    for phase in phases:
+        totals[phase['name']] = round(
+            totals.get(phase['name'], 0.0) + phase['duration'], 6)
+
+    return {
+        'elapsed': round(time.monotonic() - _origin, 6),
+        'marks': marks,
+        'totals': totals,
+        'phases': phases,
+    }
+
+
+def write_timing_report(filename=None):
+    """Write the timing report as JSON to filename, or stdout if None."""
+    report = json.dumps(get_timing_report(), indent=2)
+    if filename is None:
+        sys.stdout.write(report + "\n")
+        sys.stdout.flush()
+        return
+    with open(filename, 'w', encoding='utf-8') as report_file:
+        report_file.write(report + "\n")